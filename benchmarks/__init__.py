@@ -0,0 +1,4 @@
+# Benchmarks of the heartbeat stages on synthetic recordings with known beats.
+# run with: python -m benchmarks.run --help
+# load test of the live ingestion server (remo.ingest) with fake devices:
+# python -m benchmarks.ingest --help
@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from .run import environment
+
+# modules whose cold import is measured; numpy is the baseline everything needs
+MODULES = ['numpy', 'heartbeat', 'heartbeat.stream', 'remo', 'converter']
+
+# heavy dependencies that importing the packages must not load, they are imported by
+# the stages that use them
+HEAVY = ['scipy', 'pandas', 'matplotlib']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# measured inside a fresh interpreter: import time and the heavy modules it loaded
+PROBE = '''
+import json, sys, time
+t1 = time.perf_counter()
+import %s
+seconds = time.perf_counter() - t1
+print(json.dumps({'seconds': seconds, 'loaded': [m for m in %r if m in sys.modules]}))
+'''
+
+# cold imports of module in repeat fresh interpreters, returns the median import time,
+# the median wall time of the whole interpreter run and the heavy modules loaded
+def measure_import(module, repeat=5):
+	imports = []
+	runs = []
+	for _ in range(repeat):
+		t1 = time.perf_counter()
+		output = subprocess.check_output([sys.executable, '-c', PROBE % (module, HEAVY)], cwd=ROOT)
+		runs.append(time.perf_counter() - t1)
+		result = json.loads(output.decode().strip().splitlines()[-1])
+		imports.append(result['seconds'])
+	return {
+		'module': module,
+		'import_seconds': float(np.median(imports)),
+		'process_seconds': float(np.median(runs)),
+		'heavy_loaded': result['loaded'],
+	}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark and guard the cold import time of the packages.')
+	parser.add_argument('-m', '--modules', nargs='+', default=MODULES)
+	parser.add_argument('-r', '--repeat', type=int, default=5, help='fresh interpreters per module, the median is reported')
+	parser.add_argument('-o', '--output', default='imports.json', help='JSON file to write the results to')
+	parser.add_argument('--max-overhead', type=float, default=0.1,
+						help='fail when a module takes more than this many seconds longer to import than numpy')
+	args = parser.parse_args()
+
+	results = [measure_import(module, args.repeat) for module in args.modules]
+	baseline = measure_import('numpy', args.repeat)['import_seconds']
+	failures = []
+	for result in results:
+		result['overhead_seconds'] = result['import_seconds'] - baseline
+		print('%-18s %8.1fms import  %8.1fms process  %s' % (
+			result['module'], 1000 * result['import_seconds'], 1000 * result['process_seconds'],
+			', '.join(result['heavy_loaded'])))
+		if result['module'] == 'numpy':
+			continue
+		if result['heavy_loaded']:
+			failures.append('%s loads %s' % (result['module'], ', '.join(result['heavy_loaded'])))
+		if result['overhead_seconds'] > args.max_overhead:
+			failures.append('%s takes %.1fms longer to import than numpy' % (
+				result['module'], 1000 * result['overhead_seconds']))
+
+	with open(args.output, 'w') as f:
+		json.dump({'environment': environment(), 'numpy_seconds': baseline, 'results': results,
+				   'failures': failures}, f, indent=2)
+	for failure in failures:
+		print('FAIL: %s' % failure)
+	sys.exit(1 if failures else 0)
@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from remo.loader import load_record
+from .run import environment, to_builtin
+from .synthetic import synthetic_recording
+
+SESSIONS = [1, 2, 4, 8, 16, 32, 64, 128]
+
+# preamble of a fake recording, as the lab software writes it
+PREAMBLE = '''Robot Emotion Regulation Study (fake device),,,,,,,
+,,,,,,,
+,,,,,,,
+Participant ID: %s,,,,,,,
+Condition ID: %s,,,,,,,
+-------------------------------------------------------------,,,,,,,
+,,,,,,,
+unix_timestamp,heart_rate_voltage,accelerometer_x,accelerometer_y,accelerometer_z,servo_position,arduino_timestamp,note
+'''
+
+# the columns of a synthetic recording after the unix timestamp, one bytes row each
+def row_suffixes(record, rng):
+	samples = len(record['heart_rate_voltage'])
+	accelerometer = np.array([-1.2, 6.8, 6.1]) + rng.normal(0, 0.03, (samples, 3))
+	micros = 5000000 + np.round((record['unix_timestamp'] - record['unix_timestamp'][0]) * 1000).astype(np.int64)
+	return [b',%i,%.2f,%.2f,%.2f,0,%i,datapoint\n' % (v, x, y, z, us) for v, (x, y, z), us in
+			zip(record['heart_rate_voltage'], accelerometer, micros)]
+
+# streams a synthetic recording in real time like a REMO device: the preamble, then every
+# chunk_interval seconds the rows that are due, stamped with the current unix time.
+# with split_preamble the preamble is sent a line per write, so it arrives over several reads.
+# connects to a unix socket at path, or to host:port
+async def fake_device(participant, duration, host='127.0.0.1', port=8765, path=None, sample_rate=75.0,
+					  chunk_interval=0.1, condition=1, events=True, seed=None, split_preamble=False):
+	rng = np.random.default_rng(seed)
+	record = synthetic_recording(duration, sample_rate=sample_rate, rng=rng)
+	offsets = record['unix_timestamp'] - record['unix_timestamp'][0]
+	suffixes = row_suffixes(record, rng)
+	if path:
+		reader, writer = await asyncio.open_unix_connection(path)
+	else:
+		reader, writer = await asyncio.open_connection(host, port)
+
+	preamble = (PREAMBLE % (participant, condition)).encode()
+	if split_preamble:
+		for line in preamble.splitlines(True):
+			writer.write(line)
+			await writer.drain()
+			await asyncio.sleep(0.01)
+	else:
+		writer.write(preamble)
+	start = time.time() * 1000.0
+	if events:
+		writer.write(b'%i,null,null,null,null,null,null,start experiment\n' % start)
+	sent = 0
+	while sent < len(suffixes):
+		await asyncio.sleep(chunk_interval)
+		now = time.time() * 1000.0
+		due = np.searchsorted(offsets, now - start, side='right')
+		writer.write(b''.join(b'%i' % (start + offset) + suffix for offset, suffix in
+							  zip(offsets[sent:due], suffixes[sent:due])))
+		sent = due
+		await writer.drain()
+	if events:
+		writer.write(b'%i,null,null,null,null,null,null,end experiment\n' % (time.time() * 1000.0))
+	writer.close()
+	await writer.wait_closed()
+	return sent
+
+# every other device sends its preamble a line per write
+async def fake_devices(sessions, duration, **device_args):
+	return await asyncio.gather(*[fake_device('fake%i' % i, duration, seed=i, split_preamble=i % 2 == 1,
+											  **device_args) for i in range(sessions)])
+
+# runs the ingestion server in a subprocess and streams to it from sessions fake devices at once
+# for duration seconds. returns the largest lags and the analysis statistics over the status
+# records of the server, leaving out the first warmup seconds, and the number of written
+# recordings whose preamble lost the participant or condition ID
+def load_test(sessions, duration, workers=None, window=60.0, interval=5.0, status_interval=1.0,
+			  warmup=5.0, chunk_interval=0.1):
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'ingest.sock')
+		status = os.path.join(tmp, 'status.jsonl')
+		command = [sys.executable, '-m', 'remo.ingest', '-q', '--unix', path, '-o', os.path.join(tmp, 'recordings'),
+				   '--status', status, '--status-interval', str(status_interval),
+				   '--window', str(window), '--interval', str(interval)]
+		if workers:
+			command += ['-j', str(workers)]
+		server = subprocess.Popen(command)
+		try:
+			while not os.path.exists(path):
+				time.sleep(0.05)
+			t1 = time.time()
+			sent = asyncio.run(fake_devices(sessions, duration, path=path, chunk_interval=chunk_interval))
+			time.sleep(status_interval)
+		finally:
+			server.terminate()
+			server.wait()
+		with open(status) as f:
+			records = [json.loads(line) for line in f]
+		recordings = [os.path.join(tmp, 'recordings', name) for name in os.listdir(os.path.join(tmp, 'recordings'))]
+		written = sum(os.path.getsize(recording) for recording in recordings)
+		infos = [load_record(recording)[0] for recording in recordings]
+		lost_ids = sum(1 for info in infos if 'Participant ID' not in info or 'Condition ID' not in info)
+
+	records = [record for record in records if record['time'] >= t1 + warmup]
+	session_records = [record for record in records if record['session'] is not None]
+	server_records = [record for record in records if record['session'] is None]
+	analysed = [record for record in session_records if 'analysis_seconds' in record]
+	return {
+		'sessions': sessions,
+		'duration': duration,
+		'rows_sent': int(sum(sent)),
+		'bytes_written': written,
+		'lag_p99': max([record.get('lag_p99', np.nan) for record in session_records] or [np.nan]),
+		'lag_max': max([record.get('lag_max', np.nan) for record in session_records] or [np.nan]),
+		'loop_lag_max': max([record['loop_lag'] for record in server_records] or [np.nan]),
+		'analysis_seconds_max': max([record['analysis_seconds'] for record in analysed] or [np.nan]),
+		'analysis_lag_max': max([record['analysis_lag'] for record in analysed] or [np.nan]),
+		'analysis_errors': len(set((r['session'], r['analysis_error']) for r in analysed if 'analysis_error' in r)),
+		'skipped': max([record['skipped'] for record in session_records] or [0]),
+		'lost_ids': lost_ids,
+	}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Load test the ingestion server with fake devices.')
+	parser.add_argument('-s', '--sessions', type=int, nargs='+', default=SESSIONS, help='simultaneous sessions to try')
+	parser.add_argument('-d', '--duration', type=float, default=60.0, help='seconds every fake device streams')
+	parser.add_argument('-o', '--output', default='ingest.json', help='JSON file to write the results to')
+	parser.add_argument('-j', '--workers', type=int, default=None, help='analysis worker processes of the server')
+	parser.add_argument('--window', type=float, default=60.0, help='seconds of samples the rolling measures cover')
+	parser.add_argument('--interval', type=float, default=5.0, help='seconds between rolling analyses')
+	parser.add_argument('--chunk-interval', type=float, default=0.1, help='seconds between the writes of a device')
+	parser.add_argument('--max-lag', type=float, default=250.0, help='largest acceptable p99 arrival lag in ms')
+	args = parser.parse_args()
+
+	results = []
+	for sessions in args.sessions:
+		result = load_test(sessions, args.duration, workers=args.workers, window=args.window,
+						   interval=args.interval, chunk_interval=args.chunk_interval)
+		result['ok'] = bool(result['lag_p99'] <= args.max_lag and result['skipped'] == 0 and
+							result['analysis_lag_max'] <= args.interval and result['lost_ids'] == 0)
+		results.append(result)
+		print('%4i sessions  lag p99 %7.1f ms  max %7.1f ms  loop lag %6.1f ms  analysis %6.3fs  skipped %i  lost ids %i  %s' % (
+			sessions, result['lag_p99'], result['lag_max'], 1000 * result['loop_lag_max'],
+			result['analysis_lag_max'], result['skipped'], result['lost_ids'], 'ok' if result['ok'] else 'OVERLOADED'))
+
+	passed = [result['sessions'] for result in results if result['ok']]
+	print('Most sessions with bounded latency: %s' % (max(passed) if passed else 'none'))
+	with open(args.output, 'w') as f:
+		json.dump({'environment': environment(), 'max_lag': args.max_lag, 'results': results}, f,
+				  indent=2, default=to_builtin)
+	print('Results written to %s' % args.output)
@@ -0,0 +1,205 @@
+import argparse
+import json
+import platform
+import time
+
+import numpy as np
+import scipy
+
+import heartbeat as hb
+from .synthetic import beat_times, expected_lf_hf, synthetic_recording, match_peaks
+
+DURATIONS = [60, 600, 3600, 86400]
+
+# best of repeat runs of func(*args), in seconds, and the result of the last run.
+# setup() is called before every run and returns fresh args for stages that modify them
+def timed(func, setup, repeat):
+	best = np.inf
+	for _ in range(repeat):
+		args = setup()
+		t1 = time.perf_counter()
+		result = func(*args)
+		best = min(best, time.perf_counter() - t1)
+	return best, result
+
+# times every stage of the analysis on one synthetic recording, in pipeline order so
+# each stage gets the outputs of the stages before it, and checks the detected peaks
+def benchmark_recording(duration, repeat=3, calc_freq=True, hampel=True, **signal_args):
+	record = synthetic_recording(duration, **signal_args)
+	fs = hb.get_samplerate_mstimer(record['unix_timestamp'], working_data={})
+	filtered = hb.butter_lowpass_filter(record['heart_rate_voltage'], cutoff=np.floor(fs / 4),
+										sample_rate=fs, order=3)
+	hrdata = hb.enhance_peaks(filtered, iterations=2)
+
+	working_data = {'hr': hrdata, 'sample_rate': fs}
+	measures = {}
+	stages = {}
+
+	stages['rolmean'], rol_mean = timed(hb.rolmean, lambda: (hrdata, 0.75, fs), repeat)
+	stages['fit_peaks'], _ = timed(
+		lambda: hb.fit_peaks(hrdata, rol_mean, fs, working_data=working_data), tuple, repeat)
+	hb.calc_rr(fs, working_data=working_data)
+	stages['check_peaks'], _ = timed(
+		lambda: hb.check_peaks(working_data=working_data), tuple, repeat)
+	hb.calc_ts_measures(working_data=working_data, measures=measures)
+	if calc_freq:
+		stages['calc_fd_measures'], _ = timed(
+			lambda: hb.calc_fd_measures(hrdata, fs, working_data=working_data, measures=measures),
+			tuple, repeat)
+	stages['calc_breathing'], _ = timed(
+		lambda: hb.calc_breathing(fs, working_data=working_data, measures=measures), tuple, repeat)
+	if hampel:
+		stages['hampelfilt'], _ = timed(
+			hb.hampelfilt, lambda: (record['heart_rate_voltage'].astype(np.float64), 6), repeat)
+		# as run by process(hampel_correct=True), a window of one second
+		stages['hampel_correcter'], _ = timed(hb.hampel_correcter, lambda: (hrdata, fs), repeat)
+
+	peaklist = np.asarray(working_data['peaklist'])
+	accepted = peaklist[np.asarray(working_data['binary_peaklist']) == 1]
+	tolerance = int(round(0.05 * fs))
+	return {
+		'duration': duration,
+		'samples': len(hrdata),
+		'sample_rate': fs,
+		'signal': signal_args,
+		'stages': stages,
+		'total': sum(stages.values()),
+		'accuracy': {
+			'tolerance_samples': tolerance,
+			'detected': match_peaks(peaklist, record['beats'], tolerance),
+			'accepted': match_peaks(accepted, record['beats'], tolerance),
+			'true_bpm': record['bpm'],
+			'bpm': measures['bpm'],
+			'best_ma_perc': working_data['best'],
+		},
+	}
+
+# LF/HF of the exact RR intervals of synthetic beats, with known LF and HF modulation, by
+# 'welch' (resampled at 4Hz) and 'lomb'. the methods agree when both are within tolerance
+# (relative) of each other and of the expected ratio, and their LF power is on the same scale
+# within tolerance. the modulation frequencies are off
+# any round frequency grid, so a spectrum sampled too coarsely misses their power
+def check_frequency_domain(duration=600, seeds=(0, 1, 2), tolerance=0.2, breathing_rate=0.237,
+						   lf_rate=0.093):
+	checks = []
+	for seed in seeds:
+		rr_list = np.diff(beat_times(duration, breathing_rate=breathing_rate, lf_rate=lf_rate,
+									 rng=seed)) * 1000.0
+		lf_hf = {}
+		lf = {}
+		for method in ['welch', 'lomb']:
+			measures = {}
+			hb.calc_fd_measures(None, None, method=method, working_data={'RR_list_cor': rr_list},
+								measures=measures, resample_rate=4.0)
+			lf_hf[method] = measures['lf/hf']
+			lf[method] = measures['lf']
+		checks.append({
+			'seed': seed,
+			'lf/hf': lf_hf,
+			'lf': lf,
+			'agree': bool(abs(lf_hf['lomb'] - lf_hf['welch']) <= tolerance * lf_hf['welch'] and
+						  abs(lf['lomb'] - lf['welch']) <= tolerance * lf['welch'] and
+						  all(abs(value - expected_lf_hf()) <= tolerance * expected_lf_hf()
+							  for value in lf_hf.values())),
+		})
+	return {'duration': duration, 'expected_lf/hf': expected_lf_hf(), 'tolerance': tolerance,
+			'checks': checks, 'agree': all(check['agree'] for check in checks)}
+
+# repairs synthetic recordings clipped at clip_level with interpolate_peaks() and compares them
+# with the same recordings unclipped. the repair is within range when the unclipped samples are
+# unchanged and every repaired sample lies between the clipping level and as far above it as the
+# signal in the 100ms around the segment spans. the error is against the unclipped recording
+def check_clipping_repair(duration=600, seeds=(0, 1, 2), clip_level=700, sample_rate=75.0):
+	checks = []
+	for seed in seeds:
+		truth = synthetic_recording(duration, sample_rate=sample_rate, noise=0, clip_level=2000,
+									rng=seed)['heart_rate_voltage'].astype(float)
+		clipped = synthetic_recording(duration, sample_rate=sample_rate, noise=0, clip_level=clip_level,
+									  rng=seed)['heart_rate_voltage'].astype(float)
+		working_data = {}
+		repaired = hb.interpolate_peaks(clipped.copy(), sample_rate, threshold=clip_level - 1,
+										working_data=working_data)
+		changed = repaired != clipped
+		num_datapoints = int(0.1 * sample_rate)
+		in_range = True
+		for start, end in working_data['clipping_segments']:
+			segment = repaired[start:end + 1]
+			around = clipped[max(start - num_datapoints, 0):end + num_datapoints + 1]
+			upper = clip_level + around.max() - around.min()
+			in_range &= bool(np.all((segment >= clip_level) & (segment <= upper)))
+		is_clipped = clipped >= clip_level
+		checks.append({
+			'seed': seed,
+			'segments': working_data['clipping_count'],
+			'unclipped_unchanged': not np.any(changed & ~is_clipped),
+			'in_range': in_range,
+			'max_error': float(np.max(np.abs(repaired - truth)[is_clipped], initial=0)),
+		})
+	return {'duration': duration, 'clip_level': clip_level, 'checks': checks,
+			'ok': all(check['unclipped_unchanged'] and check['in_range'] for check in checks)}
+
+# versions and machine the results were measured with
+def environment():
+	return {
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'scipy': scipy.__version__,
+		'heartbeat': hb.__version__,
+		'machine': platform.machine(),
+		'processor': platform.processor(),
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+	}
+
+# json can't hold numpy scalars
+def to_builtin(value):
+	if isinstance(value, np.generic):
+		return value.item()
+	raise TypeError('%r is not JSON serializable' % (value,))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the heartbeat stages on synthetic recordings.')
+	parser.add_argument('-d', '--durations', type=float, nargs='+', default=DURATIONS,
+						help='recording lengths in seconds (default 1 minute to 24 hours)')
+	parser.add_argument('-o', '--output', default='benchmark.json', help='JSON file to write the results to')
+	parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per stage, the best is reported')
+	parser.add_argument('--sample-rate', type=float, default=75.0)
+	parser.add_argument('--bpm', type=float, default=70.0)
+	parser.add_argument('--noise', type=float, default=5.0, help='white noise standard deviation in ADC units')
+	parser.add_argument('--wander', type=float, default=30.0, help='baseline wander amplitude in ADC units')
+	parser.add_argument('--clip-level', type=int, default=1023, help='ADC value above which the signal is clipped')
+	parser.add_argument('--jitter', type=float, default=1.5, help='sampling jitter standard deviation in ms')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--no-freq', action='store_true', help='skip calc_fd_measures')
+	parser.add_argument('--no-hampel', action='store_true', help='skip hampelfilt and hampel_correcter')
+	args = parser.parse_args()
+
+	results = []
+	for duration in args.durations:
+		result = benchmark_recording(duration, repeat=args.repeat, calc_freq=not args.no_freq,
+									 hampel=not args.no_hampel, sample_rate=args.sample_rate,
+									 bpm=args.bpm, noise=args.noise, wander=args.wander,
+									 clip_level=args.clip_level, jitter=args.jitter, rng=args.seed)
+		results.append(result)
+		accepted = result['accuracy']['accepted']
+		print('%8is  %9i samples  %8.3fs  recall %.4f  precision %.4f' % (
+			duration, result['samples'], result['total'], accepted['recall'], accepted['precision']))
+		for stage, seconds in result['stages'].items():
+			print('\t%-18s %.4fs' % (stage, seconds))
+
+	frequency_domain = check_frequency_domain()
+	print('LF/HF welch vs lomb (expected %.3f): %s  %s' % (
+		frequency_domain['expected_lf/hf'],
+		'  '.join('%.3f/%.3f' % (check['lf/hf']['welch'], check['lf/hf']['lomb'])
+				  for check in frequency_domain['checks']),
+		'agree' if frequency_domain['agree'] else 'DISAGREE'))
+	clipping_repair = check_clipping_repair()
+	print('Clipping repair at %i: %s  %s' % (
+		clipping_repair['clip_level'],
+		'  '.join('%i segments, max error %.1f' % (check['segments'], check['max_error'])
+				  for check in clipping_repair['checks']),
+		'ok' if clipping_repair['ok'] else 'OUT OF RANGE'))
+
+	with open(args.output, 'w') as f:
+		json.dump({'environment': environment(), 'results': results, 'frequency_domain': frequency_domain,
+				   'clipping_repair': clipping_repair}, f, indent=2, default=to_builtin)
+	print('Results written to %s' % args.output)
@@ -0,0 +1,117 @@
+import numpy as np
+
+# shape of one heart beat as gaussian waves (P, Q, R, S, T):
+# offset to the R peak in seconds, width in seconds, amplitude relative to the R wave
+BEAT_WAVES = np.array([
+	[-0.20, 0.025, 0.12],
+	[-0.03, 0.010, -0.15],
+	[0.00, 0.012, 1.00],
+	[0.03, 0.010, -0.25],
+	[0.25, 0.040, 0.20],
+])
+BEAT_EXTENT = 0.45
+ADC_MAX = 1023
+
+# relative amplitudes of the RR interval modulation by breathing (HF band) and the slower
+# 0.1Hz rhythm (LF band). sinusoids hold power proportional to their amplitude squared
+HF_MODULATION = 0.5
+LF_MODULATION = 0.3
+LF_FREQUENCY = 0.1
+
+# the LF/HF ratio of the modulation of beat_times(), frequency domain measures should find it
+def expected_lf_hf():
+	return (LF_MODULATION / HF_MODULATION) ** 2
+
+# beat times in seconds for a recording of the given duration, with respiratory
+# sinus arrhythmia, a slower (LF) rhythm and random beat to beat variation
+def beat_times(duration, bpm=70.0, hrv=0.05, breathing_rate=0.25, lf_rate=LF_FREQUENCY, rng=None):
+	rng = np.random.default_rng(rng)
+	count = int(duration * bpm / 60.0 * 1.5) + 2
+	interval = 60.0 / bpm
+	times = np.empty(0)
+	t = BEAT_EXTENT
+	while t < duration - BEAT_EXTENT:
+		nominal = t + interval * np.arange(count)
+		rr = interval * (1 + hrv * (HF_MODULATION * np.sin(2 * np.pi * breathing_rate * nominal) +
+									LF_MODULATION * np.sin(2 * np.pi * lf_rate * nominal) +
+									0.2 * rng.standard_normal(count)))
+		block = t + np.cumsum(rr)
+		times = np.concatenate((times, block))
+		t = block[-1]
+	return times[times < duration - BEAT_EXTENT]
+
+# synthetic heart rate recording like the REMO arduino logs, a 10-bit ADC voltage
+# sampled at (jittered) millisecond timestamps. returns a dict with
+#	unix_timestamp		int64 sample times in ms
+#	heart_rate_voltage	int64 ADC values in [0, 1023], flattened above clip_level
+#	beats				sample index of every R peak, the ground truth for peak detection
+#	beat_times			exact R peak times in seconds
+#	bpm					the mean heart rate of the generated beats
+# noise is the standard deviation of white noise in ADC units, wander the amplitude
+# of baseline wander and jitter the standard deviation of sampling time jitter in ms
+def synthetic_recording(duration, sample_rate=75.0, bpm=70.0, hrv=0.05, amplitude=350.0,
+						baseline=400.0, noise=5.0, wander=30.0, clip_level=ADC_MAX, jitter=1.5,
+						start_time=1500000000000, rng=None, blocksize=2**16):
+	rng = np.random.default_rng(rng)
+	samples = int(duration * sample_rate)
+	times = np.arange(samples) / sample_rate
+	if jitter:
+		times += rng.normal(0, jitter / 1000.0, samples)
+		times = np.maximum.accumulate(times)
+
+	beats_t = beat_times(duration, bpm, hrv, rng=rng)
+	signal = baseline + wander * np.sin(2 * np.pi * 0.15 * times)
+	if noise:
+		signal += rng.normal(0, noise, samples)
+
+	# add every beat to the samples around it, in blocks of beats to bound memory use
+	extent = int(np.ceil(2 * BEAT_EXTENT * sample_rate)) + 2
+	window = np.arange(extent) - extent // 2
+	centers = np.searchsorted(times, beats_t)
+	for start in range(0, len(beats_t), blocksize):
+		idx = np.clip(centers[start:start + blocksize, None] + window, 0, samples - 1)
+		offsets = times[idx] - beats_t[start:start + blocksize, None]
+		wave = np.zeros(idx.shape)
+		for offset, width, amp in BEAT_WAVES:
+			wave += amp * np.exp(-0.5 * ((offsets - offset) / width) ** 2)
+		wave[np.abs(offsets) > BEAT_EXTENT] = 0
+		np.add.at(signal, idx.ravel(), amplitude * wave.ravel())
+
+	voltage = np.clip(np.round(signal), 0, min(clip_level, ADC_MAX)).astype(np.int64)
+
+	# ground truth is the sample nearest to each R peak
+	beats = np.clip(np.searchsorted(times, beats_t), 1, samples - 1)
+	beats -= (beats_t - times[beats - 1]) < (times[beats] - beats_t)
+
+	return {
+		'unix_timestamp': start_time + np.round(times * 1000).astype(np.int64),
+		'heart_rate_voltage': voltage,
+		'beats': beats,
+		'beat_times': beats_t,
+		'bpm': 60.0 / np.mean(np.diff(beats_t)),
+	}
+
+# compares detected peaks (sample indices) with the ground truth, a peak is a hit
+# when it is within tolerance samples of a true beat (each detected peak counts once)
+def match_peaks(detected, truth, tolerance):
+	detected = np.sort(np.asarray(detected, dtype=np.int64))
+	truth = np.asarray(truth, dtype=np.int64)
+	if len(detected) == 0 or len(truth) == 0:
+		hits = 0
+		errors = np.zeros(0)
+	else:
+		right = np.clip(np.searchsorted(detected, truth), 0, len(detected) - 1)
+		left = np.maximum(right - 1, 0)
+		nearest = np.where(np.abs(detected[left] - truth) <= np.abs(detected[right] - truth), left, right)
+		errors = detected[nearest] - truth
+		within = np.abs(errors) <= tolerance
+		hits = len(np.unique(nearest[within]))
+		errors = errors[within]
+	return {
+		'true_beats': int(len(truth)),
+		'detected': int(len(detected)),
+		'hits': int(hits),
+		'recall': hits / len(truth) if len(truth) else np.nan,
+		'precision': hits / len(detected) if len(detected) else np.nan,
+		'mean_abs_error': float(np.mean(np.abs(errors))) if len(errors) else np.nan,
+	}
@@ -1,64 +1,238 @@
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
-import pandas as pd
 
 # from	 	https://github.com/paulvangentcom/heartrate_analysis_python
 # docs at 	https://python-heart-rate-analysis-toolkit.readthedocs.io/en/latest/
-import heartbeat as hb 
-
-import csv
-
-def clamp(x, mn, mx):
-	if (x > mx):
-		return mx
-	if (x < mn):
-		return mn
-	return x
-
-# custom int converter decorator to deal with null values
-# clamps as well
-# returns int(x) if the input isn't the string "null"
-def intr(x):
-	ret = x
-	if (x=='null'):
-		return 0
-	return clamp(int(x), 0, 1024)
-
-# Processing needs to be done for our custom CSV header
-with open('data/record_1537397981102_00047BB63.csv', newline='') as csvfile:
-	reader = csv.reader(csvfile)
-	rawdata = [x for x in reader]
-	header_index = 7
-	header = rawdata[header_index]
-	
-	k = 0
-	for row in rawdata:
-		if len(row) < 1:
-			continue
-		if row[-1] == "start experiment":
-			break
-		k=k+1
-
-	print("The start of the experiment was at line %i." % (k))
-
-	body = np.array(rawdata[k:])
-	data = pd.DataFrame(body, columns=header)
-
-fs = hb.get_samplerate_mstimer([int(x) for x in data['unix_timestamp'].tolist()])
-
-# print(np.floor(1000 / np.mean(diffs)) / 4)
-
-voltages = np.array([intr(x) for x in data['heart_rate_voltage'].tolist()])
-filtered = hb.butter_lowpass_filter(voltages, cutoff=np.floor(fs / 4), sample_rate=fs, order=3)
-enhanced = hb.enhance_peaks(filtered, iterations=2)
-
-measures = hb.process(
-	enhanced,				# array-like
-	fs,						# frequency
-	report_time=True,		# print the time for processing
-	calc_freq=True,			# calcuate frequency domain
-	interp_clipping=False,	# implied peak is interpolated
-	interp_threshold=940	# amp beyond which will be checked for clipping
-)
-
-# Visualize peaks for inspection
-hb.plotter()
+import heartbeat as hb
+from heartbeat.profiling import Profile, jsonlines_sink
+import remo
+
+# parameters of the analysis, part of the key of stored results
+ANALYSIS = {
+	'cutoff': 0.25,				# lowpass cutoff, as a fraction of the sample rate
+	'highpass': None,			# highpass cutoff in Hz against baseline wander, None to only lowpass
+	'order': 3,					# lowpass filter order
+	'enhance_iterations': 2,
+	'windowsize': 0.75,
+	'bpmmin': 40,
+	'bpmmax': 180,
+	'interp_clipping': False,	# implied peak is interpolated
+	'interp_threshold': 940,	# amp beyond which will be checked for clipping
+	'freq_method': 'welch',		# method of the frequency domain measures, see hb.calc_fd_measures()
+	'freq_resample_rate': 4.0,	# rate in Hz the RR intervals are resampled at for them
+	'dtype': 'float64',			# precision of filtering and enhancing, see process_record()
+}
+
+# runs the full chain on one recording, returns the preamble info, the measures, a list
+# with the measures of every phase between the events of the recording (with phases)
+# and the working_data holding the peaks
+# with a cache_dir the parsed recording is cached there for later runs,
+# with a profile_file the time and memory of every stage are appended to it as JSON lines,
+# with a plot_dir a QC plot of the detected peaks is saved there as <record>.<plot_format>
+# with motion, no peaks are searched while the accelerometer shows the participant moving
+# with resample, the channels are resampled onto a uniform grid timed by the arduino clock
+# analysis holds the parameters of the analysis, see ANALYSIS. a float32 dtype halves the
+# memory of filtering and enhancing, but the peak of the chain is in hb.process(), which works
+# in float64: on an hour at 75Hz the chain peaks at 32MB in float64 and 31MB in float32
+# arrays names the entries of working_data to return, None for all of them
+def process_record(filename, calc_freq=True, cache_dir=None, profile_file=None, plot_dir=None,
+				   plot_format='png', motion=True, resample=True, phases=False, analysis=ANALYSIS,
+				   arrays=None):
+	if cache_dir:
+		info, data, events = remo.load_cached_record(filename, cache_dir)
+	else:
+		info, data, events = remo.load_record(filename)
+	if resample:
+		data, timebase = remo.resample(data)
+		fs = timebase['sample_rate']
+	else:
+		fs = hb.get_samplerate_mstimer(data['unix_timestamp'])
+
+	# print(np.floor(1000 / np.mean(diffs)) / 4)
+
+	cutoff = np.floor(fs * analysis['cutoff'])
+	dtype = np.dtype(analysis['dtype'])
+	if analysis['highpass']:
+		filtered = hb.bandpass_filter(data['heart_rate_voltage'], analysis['highpass'], cutoff,
+									  sample_rate=fs, order=analysis['order'], dtype=dtype)
+	else:
+		filtered = hb.butter_lowpass_filter(data['heart_rate_voltage'], cutoff=cutoff,
+											sample_rate=fs, order=analysis['order'], dtype=dtype)
+	# filtered isn't used after this, so it is enhanced in place
+	enhanced = hb.enhance_peaks(filtered, iterations=analysis['enhance_iterations'], inplace=True)
+	artifact_mask = remo.motion_mask(data, fs) if motion else None
+
+	profile = None
+	if profile_file:
+		profile = Profile(sinks=[jsonlines_sink(profile_file)], file=os.path.basename(filename))
+
+	working_data = {}
+	measures = hb.process(
+		enhanced,				# array-like
+		fs,						# frequency
+		calc_freq=calc_freq,	# calcuate frequency domain
+		freq_method=analysis['freq_method'],
+		freq_resample_rate=analysis['freq_resample_rate'],
+		windowsize=analysis['windowsize'],
+		bpmmin=analysis['bpmmin'],
+		bpmmax=analysis['bpmmax'],
+		interp_clipping=analysis['interp_clipping'],
+		interp_threshold=analysis['interp_threshold'],
+		working_data=working_data,
+		artifact_mask=artifact_mask,	# motion artifacts
+		profile=profile			# per stage time and memory
+	)
+	if profile:
+		measures = measures[0]
+
+	if plot_dir:
+		name = os.path.splitext(os.path.basename(filename))[0]
+		title = 'Participant %s, condition %s' % (info.get('Participant ID'), info.get('Condition ID'))
+		hb.save_plot(os.path.join(plot_dir, '%s.%s' % (name, plot_format)), title=title,
+					 working_data=working_data, measures=measures)
+
+	phase_measures = []
+	if phases:
+		# phases slice the peaks fitted over the whole recording
+		if resample:
+			rows = remo.grid_index(timebase, [row for row, note in events])
+			events = [(row, note) for row, (_, note) in zip(rows, events)]
+		bounds = remo.phase_bounds(events, len(enhanced))
+		phase_measures = remo.phase_measures(bounds, fs, working_data, calc_freq=calc_freq,
+											 freq_method=analysis['freq_method'],
+											 freq_resample_rate=analysis['freq_resample_rate'])
+	if arrays is not None:
+		working_data = {name: working_data[name] for name in arrays if name in working_data}
+	return info, measures, phase_measures, working_data
+
+# expands directories and glob patterns into a sorted list of record_*.csv files
+def find_records(paths):
+	files = []
+	for path in paths:
+		if os.path.isdir(path):
+			path = os.path.join(path, 'record_*.csv')
+		files.extend(glob.glob(path))
+	return sorted(set(files))
+
+# summary rows of one recording, one per phase with phases
+def summary_rows(filename, info, measures, phase_measures, phases=False):
+	row = {
+		'participant': info.get('Participant ID'),
+		'condition': info.get('Condition ID'),
+		'file': os.path.basename(filename),
+	}
+	if phases:
+		return [dict(row, **phase) for phase in phase_measures]
+	row.update({k: v for k, v in measures.items() if np.isscalar(v)})
+	return [row]
+
+# processes all files over a process pool, one row per recording (or per phase, with phases)
+# keyed by participant and condition; recordings that fail are reported and skipped
+# with a store (path of an SQLite database) results are stored there, keyed by the contents
+# of the recording and all parameters, and recordings with stored results aren't processed again
+# analysis holds the parameters of the analysis, see ANALYSIS, and is passed to the workers.
+# the workers only send back the peak arrays the store keeps, and none without a store
+def process_batch(files, workers=None, calc_freq=True, cache_dir=None, profile_file=None,
+				  plot_dir=None, plot_format='png', motion=True, resample=True, phases=False,
+				  store=None, analysis=ANALYSIS):
+	if plot_dir:
+		os.makedirs(plot_dir, exist_ok=True)
+	params = dict(analysis, calc_freq=calc_freq, motion=motion, resample=resample, phases=phases,
+				  version=hb.__version__)
+	rows = []
+	pending = {}
+	store = remo.ResultStore(store) if store else None
+	arrays = remo.PEAK_ARRAYS if store else []
+	for filename in files:
+		sha1 = key = None
+		if store:
+			sha1 = remo.file_hash(filename)
+			key = remo.result_key(sha1, params)
+			stored = store.get(key)
+			if stored is not None:
+				rows.extend(summary_rows(filename, *stored, phases=phases))
+				continue
+		pending[filename] = (sha1, key)
+	if store:
+		print('%i of %i recordings have stored results.' % (len(files) - len(pending), len(files)))
+
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		futures = {executor.submit(process_record, f, calc_freq, cache_dir, profile_file,
+								   plot_dir, plot_format, motion, resample, phases, analysis, arrays): f
+				   for f in pending}
+		for future in as_completed(futures):
+			filename = futures[future]
+			try:
+				info, measures, phase_measures, working_data = future.result()
+			except Exception as error:
+				print('Error processing "%s": %s' % (filename, error))
+				continue
+			if store:
+				sha1, key = pending[filename]
+				store.put(key, filename, sha1, params, info, measures, phase_measures, working_data)
+			rows.extend(summary_rows(filename, info, measures, phase_measures, phases=phases))
+	if store:
+		store.close()
+
+	# pandas is only needed for the summary table, the workers never import it
+	import pandas as pd
+	summary = pd.DataFrame(rows)
+	if len(summary):
+		if phases:
+			summary = summary.sort_values(['participant', 'condition', 'file', 'segment_start'])
+			summary = summary.set_index(['participant', 'condition', 'phase'])
+		else:
+			summary = summary.sort_values(['participant', 'condition', 'file'])
+			summary = summary.set_index(['participant', 'condition'])
+	return summary
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Batch heart rate analysis of REMO recordings.')
+	parser.add_argument('paths', nargs='+', help='record_*.csv files, directories or glob patterns')
+	parser.add_argument('-o', '--output', help='write the summary table to this CSV file')
+	parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes')
+	parser.add_argument('--no-freq', action='store_true', help='skip frequency domain measures')
+	parser.add_argument('--no-motion', action='store_true', help='analyse samples recorded during motion too')
+	parser.add_argument('--no-resample', action='store_true', help='analyse samples as recorded, without resampling')
+	parser.add_argument('--store', help='keep results in this SQLite database and only process new recordings')
+	parser.add_argument('--highpass', type=float, help='also remove baseline wander below this frequency (Hz)')
+	parser.add_argument('--float32', action='store_true', help='filter and enhance in float32, at half their memory')
+	parser.add_argument('--cache-dir', help='cache parsed recordings in this directory')
+	parser.add_argument('--profile', help='append the time and memory of every stage to this JSON lines file')
+	parser.add_argument('--phases', action='store_true', help='one row per phase between the events of each recording')
+	parser.add_argument('--plot-dir', help='save a QC plot of every recording in this directory')
+	parser.add_argument('--plot-format', default='png', choices=['png', 'svg'], help='format of the QC plots')
+	parser.add_argument('--plot', action='store_true', help='visualize peaks of a single recording for inspection')
+	args = parser.parse_args()
+
+	files = find_records(args.paths)
+	# the workers get the parameters as an argument, they don't see changes to ANALYSIS
+	# when they are spawned instead of forked
+	analysis = dict(ANALYSIS)
+	if args.highpass:
+		analysis['highpass'] = args.highpass
+	if args.float32:
+		analysis['dtype'] = 'float32'
+
+	if args.plot and len(files) == 1:
+		info, measures, phase_measures, working_data = process_record(files[0], calc_freq=not args.no_freq, cache_dir=args.cache_dir,
+										profile_file=args.profile, motion=not args.no_motion,
+										resample=not args.no_resample, analysis=analysis)
+		# Visualize peaks for inspection
+		hb.plotter()
+	else:
+		print("Processing %i recordings." % (len(files)))
+		summary = process_batch(files, workers=args.workers, calc_freq=not args.no_freq,
+								cache_dir=args.cache_dir, profile_file=args.profile,
+								plot_dir=args.plot_dir, plot_format=args.plot_format,
+								motion=not args.no_motion, resample=not args.no_resample,
+								phases=args.phases, store=args.store, analysis=analysis)
+
+		if args.output:
+			summary.to_csv(args.output)
+		else:
+			print(summary.to_string())
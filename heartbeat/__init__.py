@@ -10,19 +10,45 @@ http://www.paulvangent.com/2016/03/30/analyzing-a-discrete-heart-rate-signal-usi
 <part 4 to follow after publication>
 '''
 
+from bisect import bisect_left, insort
 from datetime import datetime
+import threading
 import time
 
 import numpy as np
-from scipy.interpolate import UnivariateSpline
-from scipy.signal import butter, filtfilt, welch, periodogram
+
+#scipy is imported by the functions that need it, importing it takes several
+#times longer than numpy and is not needed for e.g. loading or plotting
+from .filtering import bandpass_filter, design_filter, highpass_filter, sosfiltfilt_chunked
+from .profiling import NullProfile, Profile, array_sizes, jsonlines_sink
 
 __author__ = "Paul van Gent"
 __version__ = "Version 0.8.2"
 __license__ = "GNU General Public License V3.0"
 
+#numpy 2.0 renamed trapz to trapezoid
+_trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+#module-level dicts, used by all functions that are not passed dicts of their own.
+#process() always works on fresh dicts and copies its results here when finished
 measures = {}
 working_data = {}
+_module_dicts_lock = threading.Lock()
+
+def _module_dict(passed, name):
+    '''Returns the passed dict, or the module-level dict called 'name' if none was passed.'''
+    if passed is None:
+        return globals()[name]
+    return passed
+
+def _update_module_dicts(working_data, measures):
+    '''Replaces the contents of the module-level dicts with the passed results.'''
+    with _module_dicts_lock:
+        for name, results in (('working_data', working_data), ('measures', measures)):
+            module_dict = globals()[name]
+            if results is not module_dict:
+                module_dict.clear()
+                module_dict.update(results)
 
 #Data handling
 def get_data(filename, delim=',', column_name='None', encoding=None):
@@ -64,30 +90,67 @@ def get_data(filename, delim=',', column_name='None', encoding=None):
     return hrdata
 
 #Preprocessing
-def scale_data(data):
+def _float_buffer(data, dtype=None, inplace=False):
+    '''Returns data as a floating point array to compute in. With inplace a numpy array
+    of that dtype is returned as it is, so it is overwritten, otherwise data is copied.
+
+    Keyword arguments:
+    data -- numpy array or list
+    dtype -- the floating point type, e.g. np.float32 to halve memory use
+             (default the dtype of floating point data, float64 otherwise)
+    inplace -- whether data may be overwritten (default False)
+    '''
+    if dtype is None:
+        dtype = getattr(data, 'dtype', None)
+        if dtype is None or not np.issubdtype(dtype, np.floating):
+            dtype = np.float64
+    if inplace and isinstance(data, np.ndarray) and data.dtype == dtype:
+        return data
+    return np.array(data, dtype=dtype)
+
+def scale_data(data, dtype=None, inplace=False):
     '''Scales data between 0 and 1024 for analysis
-    
+
+    The scaling is done in place on a single buffer. In float32 (dtype=np.float32)
+    the result is within 5e-4 of the float64 result on the 0-1024 scale.
+
     Keyword arguments:
     data -- numpy array or list to be scaled
+    dtype -- floating point type of the result (default the dtype of floating point
+             data, float64 otherwise)
+    inplace -- whether to scale data itself if it is a numpy array of dtype,
+               instead of a copy (default False)
     '''
-    range = np.max(data) - np.min(data)
+    data = _float_buffer(data, dtype, inplace)
     minimum = np.min(data)
-    data = 1024 * ((data - minimum) / range)
+    range = np.max(data) - minimum
+    np.subtract(data, minimum, out=data)
+    np.divide(data, range, out=data)
+    np.multiply(data, 1024, out=data)
     return data
 
-def enhance_peaks(hrdata, iterations=2):
+def enhance_peaks(hrdata, iterations=2, dtype=None, inplace=False):
     '''Attempts to enhance the signal-noise ratio by accentuating the highest peaks
     note: denoise first
+
+    All iterations work in place on one buffer, a copy of hrdata unless inplace is set.
+    In float32 (dtype=np.float32) the result is within about 5e-4 per iteration of the
+    float64 result on the 0-1024 scale (1e-3 at the default 2 iterations), at half the memory.
+    Peak detection in process() works in float64 whatever the dtype of hrdata, and its
+    peak memory is that of the whole chain, which float32 lowers by under 10%.
     
     Keyword arguments:
     hrdata -- numpy array or list containing heart rate data
-    iterations -- the number of scaling steps to perform (default=3)
+    iterations -- the number of scaling steps to perform (default=2)
+    dtype -- floating point type of the result (default the dtype of floating point
+             hrdata, float64 otherwise)
+    inplace -- whether to overwrite hrdata if it is a numpy array of dtype (default False)
     '''
-    scale_data(hrdata)
+    hrdata = _float_buffer(hrdata, dtype, inplace)
     for i in range(iterations):
-        hrdata = np.power(hrdata, 2)
-        hrdata = scale_data(hrdata)
-    return hrdata    
+        np.square(hrdata, out=hrdata)
+        scale_data(hrdata, inplace=True)
+    return hrdata
 
 def mark_clipping(hrdata, threshold):
     '''function that marks start and end of clipping part
@@ -100,98 +163,111 @@ def mark_clipping(hrdata, threshold):
                  to compensate for signal noise (default 1020)
     
     '''
-    clip_binary = np.where(hrdata > threshold)
-    clipping_edges = np.where(np.diff(clip_binary) > 1)[1]
-
-    clipping_segments = []
-
-    for i in range(0, len(clipping_edges)):
-        if i == 0: #if first clipping segment
-            clipping_segments.append((clip_binary[0][0], 
-                                      clip_binary[0][clipping_edges[0]]))
-        elif i == len(clipping_edges):
-            #append last entry
-            clipping_segments.append((clip_binary[0][clipping_edges[i]+1],
-                                      clip_binary[0][-1]))    
-        else:
-            clipping_segments.append((clip_binary[0][clipping_edges[i-1] + 1],
-                                      clip_binary[0][clipping_edges[i]]))
-
-    return clipping_segments
-
-def interpolate_peaks(hrdata, sample_rate, threshold=1020):
+    clip_binary = np.flatnonzero(np.asarray(hrdata) > threshold)
+    if len(clip_binary) == 0:
+        return []
+    clipping_edges = np.flatnonzero(np.diff(clip_binary) > 1)
+    starts = clip_binary[np.concatenate(([0], clipping_edges + 1))]
+    ends = clip_binary[np.concatenate((clipping_edges, [len(clip_binary) - 1]))]
+    return list(zip(starts, ends))
+
+def interpolate_peaks(hrdata, sample_rate, threshold=1020, working_data=None):
     '''function that interpolates peaks between
     the clipping segments using cubic spline interpolation.
     
-    It takes the clipping start +/- 100ms to calculate the spline.
+    It takes the 100ms before and after the clipping segment to calculate the spline,
+    and only replaces the clipped samples, never by less than their clipped value.
+    Segments of equal width are repaired
+    together with one spline fit, support points are taken from the signal before
+    any segment is repaired. Segments too close to the start or end of the signal
+    are skipped.
     
     Returns full data array with interpolated segments patched in
+    Stores the clipping segments, their count and total duration (in seconds) in
+    the working_data{} dict.
     
     keyword arguments:
-    data - 1d list or numpy array containing heart rate data
-    clipping_segments - list containing tuples of start- and 
-                        end-points of clipping segments.
+    data - 1d numpy array containing heart rate data
+    sample_rate - the sample rate of the data set
+    threshold - the threshold for clipping (default 1020)
+    working_data - dict to store clipping information in (default module-level working_data{})
     '''
+    from scipy.interpolate import CubicSpline
+    working_data = _module_dict(working_data, 'working_data')
+    hrdata = np.asarray(hrdata)
     clipping_segments = mark_clipping(hrdata, threshold)
+    segments = np.array(clipping_segments, dtype=int).reshape(-1, 2)
+    working_data['clipping_segments'] = clipping_segments
+    working_data['clipping_count'] = len(segments)
+    working_data['clipping_duration'] = np.sum(segments[:, 1] - segments[:, 0] + 1) / sample_rate
+
     num_datapoints = int(0.1 * sample_rate)
-    newx = []
-    newy = []
-    
-    for segment in clipping_segments:
-        if segment[0] < num_datapoints: 
-            #if clipping is present at start of signal, skip.
-            #We cannot interpolate accurately when there is insufficient data prior to clipping segment.
-            pass
-        else: 
-            antecedent = hrdata[segment[0] - num_datapoints : segment[0]]
-            consequent = hrdata[segment[1] : segment[1] + num_datapoints]
-            segment_data = np.concatenate((antecedent, consequent))
-        
-            interpdata_x = np.concatenate(([x for x in range(segment[0] - num_datapoints, segment[0])],
-                                            [x for x in range(segment[1], segment[1] + num_datapoints)]))
-            x_new = np.linspace(segment[0] - num_datapoints,
-                                segment[1] + num_datapoints,
-                                ((segment[1] - segment[0]) + (2 * num_datapoints)))
-        
-            interp_func = UnivariateSpline(interpdata_x, segment_data, k=3)
-            interp_data = interp_func(x_new)
-        
-            hrdata[segment[0] - num_datapoints :
-                    segment[1] + num_datapoints] = interp_data
-       
+    if num_datapoints < 2:
+        return hrdata
+    #We cannot interpolate accurately when there is insufficient data around a clipping segment.
+    segments = segments[(segments[:, 0] >= num_datapoints) &
+                        (segments[:, 1] + num_datapoints < len(hrdata))]
+    widths = segments[:, 1] - segments[:, 0] + 1
+    repair_offsets = np.concatenate(([0], np.cumsum(widths)))
+    repaired = np.empty(repair_offsets[-1])
+
+    for width in np.unique(widths):
+        group = np.flatnonzero(widths == width)
+        #x relative to the first clipped sample: 100ms before and after clipping
+        interpdata_x = np.concatenate((np.arange(-num_datapoints, 0),
+                                       np.arange(width, width + num_datapoints)))
+        segment_data = hrdata[segments[group, 0][:, None] + interpdata_x]
+        interp_data = CubicSpline(interpdata_x, segment_data, axis=1)(np.arange(width))
+        repaired[repair_offsets[group][:, None] + np.arange(width)] = interp_data
+
+    #patch all clipped samples in at once, in order of the segments
+    positions = (np.arange(repair_offsets[-1]) +
+                 np.repeat(segments[:, 0] - repair_offsets[:-1], widths))
+    #the true signal lies at or above its clipped value
+    hrdata[positions] = np.maximum(repaired, hrdata[positions])
     return hrdata
 
-def raw_to_ecg(hrdata, enhancepeaks=False):
+def raw_to_ecg(hrdata, enhancepeaks=False, dtype=None, inplace=False):
     '''Flips raw signal with negative mV peaks to normal ECG
 
     Keyword arguments:
     hrdata -- numpy array or list containing raw heart rate data
     enhancepeaks -- boolean, whether to apply peak accentuation (default False)
+    dtype -- floating point type of the result, see enhance_peaks() (default the dtype
+             of floating point hrdata, float64 otherwise)
+    inplace -- whether to overwrite hrdata if it is a numpy array of dtype (default False)
     '''
-    hrmean = np.mean(hrdata)
-    hrdata = (hrmean - hrdata) + hrmean
+    hrdata = _float_buffer(hrdata, dtype, inplace)
+    #mean accumulated in float64, also for float32 data
+    hrmean = hrdata.dtype.type(np.mean(hrdata, dtype=np.float64))
+    np.subtract(hrmean, hrdata, out=hrdata)
+    np.add(hrdata, hrmean, out=hrdata)
     if enhancepeaks:
-        hrdata = enhance_peaks(hrdata)
+        hrdata = enhance_peaks(hrdata, inplace=True)
     return hrdata
 
-def get_samplerate_mstimer(timerdata):
+def get_samplerate_mstimer(timerdata, working_data=None):
     '''Determines sample rate of data from ms-based timer.
 
     Keyword arguments:
     timerdata -- array containing values of a timer, in ms
+    working_data -- dict to store the sample rate in (default module-level working_data{})
     '''
+    working_data = _module_dict(working_data, 'working_data')
     sample_rate = ((len(timerdata) / (timerdata[-1]-timerdata[0]))*1000)
     working_data['sample_rate'] = sample_rate
     return sample_rate
 
-def get_samplerate_datetime(datetimedata, timeformat='%H:%M:%S.%f'):
+def get_samplerate_datetime(datetimedata, timeformat='%H:%M:%S.%f', working_data=None):
     '''Determines sample rate of data from datetime-based timer.
 
     Keyword arguments:
     timerdata -- array containing values of a timer, datetime strings
     timeformat -- the format of the datetime-strings in datetimedata
     default('%H:%M:%S.f', 24-hour based time including ms: 21:43:12.569)
+    working_data -- dict to store the sample rate in (default module-level working_data{})
     '''
+    working_data = _module_dict(working_data, 'working_data')
     datetimedata = np.asarray(datetimedata, dtype='str') #cast as str in case of np.bytes type
     elapsed = ((datetime.strptime(datetimedata[-1], timeformat) -
                 datetime.strptime(datetimedata[0], timeformat)).total_seconds())
@@ -213,24 +289,38 @@ def rollwindow(data, windowsize):
 def rolmean(data, windowsize, sample_rate):
     '''Calculates the rolling mean over passed data.
 
+    Window sums are taken as differences of a cumulative sum, so the cost does not
+    depend on the window size. Positions the window doesn't fully cover are set to
+    the mean of the data.
+
     Keyword arguments:
     data -- 1-dimensional numpy array or list
     windowsize -- the window size to use, in seconds (calculated as windowsize * sample_rate)
     sample_rate -- the sample rate of the data set
     '''
-    avg_hr = (np.mean(data))
-    data_arr = np.array(data)
-    rol_mean = np.mean(rollwindow(data_arr, int(windowsize*sample_rate)), axis=1)
-    missing_vals = np.array([avg_hr for i in range(0, int(abs(len(data_arr) - len(rol_mean))/2))])
-    rol_mean = np.insert(rol_mean, 0, missing_vals)
-    rol_mean = np.append(rol_mean, missing_vals)
-
-    if len(rol_mean) != len(data):
-        lendiff = len(rol_mean) - len(data)
-        if lendiff < 0:
-            rol_mean = np.append(rol_mean, 0)
-        else:
-            rol_mean = rol_mean[:-1]            
+    data_arr = np.asarray(data, dtype=np.float64)
+    avg_hr = np.mean(data_arr)
+    windowsize = int(windowsize*sample_rate)
+    if not 1 <= windowsize <= len(data_arr):
+        raise ValueError('rolling mean window of %i datapoints does not fit data of length %i'
+                         %(windowsize, len(data_arr)))
+
+    #cumulative sum of the data around its mean keeps the window sums accurate
+    cumsum = np.zeros(len(data_arr) + 1)
+    np.subtract(data_arr, avg_hr, out=cumsum[1:])
+    np.cumsum(cumsum[1:], out=cumsum[1:])
+
+    rol_mean = np.empty(len(data_arr))
+    offset = (windowsize - 1) // 2
+    valid = rol_mean[offset : offset + len(data_arr) - windowsize + 1]
+    np.subtract(cumsum[windowsize:], cumsum[:-windowsize], out=valid)
+    valid /= windowsize
+    valid += avg_hr
+    rol_mean[:offset] = avg_hr
+    rol_mean[offset + len(valid):] = avg_hr
+    if windowsize % 2 == 0:
+        #even windows are one value short of the data length, padded with 0
+        rol_mean[-1] = 0
     return rol_mean
 
 def butter_lowpass(cutoff, sample_rate, order=2):
@@ -238,25 +328,35 @@ def butter_lowpass(cutoff, sample_rate, order=2):
 
     use 'butter_lowpass_filter' to call the filter.
     '''
+    from scipy.signal import butter
     nyq = 0.5 * sample_rate
     normal_cutoff = cutoff / nyq
     b, a = butter(order, normal_cutoff, btype='low', analog=False)
     return b, a
 
-def butter_lowpass_filter(data, cutoff, sample_rate, order):
+def butter_lowpass_filter(data, cutoff, sample_rate, order, chunksize=2**20, dtype=np.float64):
     '''Applies the Butterworth lowpass filter
 
+    The filter is designed once per (cutoff, sample_rate, order) in second-order sections
+    and applied forward and backward in chunks, see heartbeat.filtering.
+
     Keyword arguments:
     data -- 1-dimensional numpy array or list containing the to be filtered data
     cutoff -- the cutoff frequency of the filter
     sample_rate -- the sample rate of the data set
     order -- the filter order (default 2)
+    chunksize -- number of samples filtered at once, bounds memory use on long
+                 recordings (default 2**20)
+    dtype -- floating point type of the result, e.g. np.float32, chunks are
+             filtered in float64 (default float64). For float32 the chunks are at
+             most heartbeat.filtering.NARROW_CHUNKSIZE samples, which more than halves
+             the peak memory of the filter
     '''
-    b, a = butter_lowpass(cutoff, sample_rate, order=order)
-    filtered_data = filtfilt(b, a, data)
+    sos = design_filter(cutoff, sample_rate, order, 'low')
+    filtered_data = sosfiltfilt_chunked(sos, data, chunksize=chunksize, dtype=dtype)
     return filtered_data
 
-def filtersignal(data, cutoff, sample_rate, order):
+def filtersignal(data, cutoff, sample_rate, order, dtype=None, inplace=False):
     '''Filters the given signal using a Butterworth lowpass filter.
 
     Keyword arguments:
@@ -264,9 +364,14 @@ def filtersignal(data, cutoff, sample_rate, order):
     cutoff -- the cutoff frequency of the filter
     sample_rate -- the sample rate of the data set
     order -- the filter order (default 2)
+    dtype -- floating point type to compute in and of the result, see
+             butter_lowpass_filter() (default float64)
+    inplace -- whether to overwrite data if it is a numpy array of dtype (default False)
     '''
-    data = np.power(np.array(data), 3)
-    filtered_data = butter_lowpass_filter(data, cutoff, sample_rate, order)
+    data = _float_buffer(data, dtype, inplace)
+    np.power(data, 3, out=data)
+    filtered_data = butter_lowpass_filter(data, cutoff, sample_rate, order,
+                                          dtype=np.float64 if dtype is None else dtype)
     return filtered_data
 
 def MAD(data):
@@ -279,10 +384,66 @@ def MAD(data):
     med = np.median(data)
     return np.median(np.abs(data - med))
 
+def rolling_median_mad(data, windowsize):
+    '''function to compute the median and median absolute deviation of
+       every window of size 'windowsize' sliding over data.
+
+    Windows are evaluated in chunks so that memory use stays bounded
+    regardless of signal length.
+
+    keyword arguments:
+    - data: 1-dimensional numpy array containing data
+    - windowsize: the number of datapoints in each window
+    '''
+    windows = rollwindow(np.ascontiguousarray(data, dtype=np.float64), windowsize)
+    median = np.empty(len(windows))
+    mad = np.empty(len(windows))
+    chunksize = max(1, 2**20 // windowsize)
+    for i in range(0, len(windows), chunksize):
+        chunk = windows[i:i + chunksize]
+        chunk_median = np.median(chunk, axis=1)
+        median[i:i + chunksize] = chunk_median
+        mad[i:i + chunksize] = np.median(np.abs(chunk - chunk_median[:, None]), axis=1)
+    return median, mad
+
+def sorted_median_mad(window):
+    '''function to compute median and median absolute deviation of an
+       already sorted window of even length without re-sorting it
+
+    The absolute deviations form two sorted runs growing outward from the middle
+    of the window, the middle deviations are selected from them by bisection.
+
+    keyword arguments:
+    - window: sorted list containing an even number of datapoints
+    '''
+    half = len(window) // 2
+    median = (window[half - 1] + window[half]) / 2
+
+    def kth_deviation(k):
+        #take i deviations from below the median and k - i from above it
+        lo = max(0, k - half)
+        hi = min(k, half)
+        while lo < hi:
+            i = (lo + hi) // 2
+            if median - window[half - 1 - i] < window[half + k - i - 1] - median:
+                lo = i + 1
+            else:
+                hi = i
+        below = median - window[half - lo] if lo > 0 else -np.inf
+        above = window[half + k - lo - 1] - median if lo < k else -np.inf
+        return max(below, above)
+
+    return median, (kth_deviation(half) + kth_deviation(half + 1)) / 2
+
 def hampelfilt(data, filtsize=6):
     '''function to detect outliers based on hampel filter
        filter takes datapoint and six surrounding samples.
        Detect outliers based on being more than 3std from window mean
+
+    All windows are first evaluated at once on the unaltered data. Corrected
+    datapoints feed into the windows that follow them, so from every outlier
+    found a running median is walked forward until a full window passes
+    without corrections.
     
     keyword arguments:
     - data: 1-dimensional numpy array containing data
@@ -291,25 +452,45 @@ def hampelfilt(data, filtsize=6):
                 of 6 means three datapoints on each side are taken.
                 total filtersize is thus filtsize + 1 (datapoint evaluated)
     '''
-    output = [x for x in data] #generate second list to prevent overwriting first
+    output = np.array(data, dtype=np.float64) #copy to prevent overwriting input
     onesided_filt = filtsize // 2
-    #madarray = [0 for x in range(0, onesided_filt)]
-    for i in range(onesided_filt, len(data) - onesided_filt - 1):
-        dataslice = output[i - onesided_filt : i + onesided_filt]
-        mad = MAD(dataslice)
-        median = np.median(dataslice)
-        if output[i] > median + (3 * mad):
-            output[i] = median
+    #window s covers output[s : s + 2 * onesided_filt] and evaluates output[s + onesided_filt]
+    num_windows = len(output) - (2 * onesided_filt) - 1
+    if onesided_filt < 1 or num_windows < 1:
+        return output
+
+    median, mad = rolling_median_mad(output, 2 * onesided_filt)
+    evaluated = output[onesided_filt : onesided_filt + num_windows]
+    outliers = np.flatnonzero(evaluated > median[:num_windows] + (3 * mad[:num_windows]))
+
+    pointer = 0
+    while pointer < len(outliers):
+        s = outliers[pointer]
+        last_corrected = s
+        window = sorted(output[s : s + (2 * onesided_filt)].tolist())
+        while s < num_windows and s <= last_corrected + onesided_filt:
+            window_median, window_mad = sorted_median_mad(window)
+            datapoint = output[s + onesided_filt]
+            if datapoint > window_median + (3 * window_mad):
+                del window[bisect_left(window, datapoint)]
+                insort(window, window_median)
+                output[s + onesided_filt] = window_median
+                last_corrected = s
+            if s + 1 < num_windows:
+                del window[bisect_left(window, output[s])]
+                insort(window, output[s + (2 * onesided_filt)])
+            s += 1
+        pointer = np.searchsorted(outliers, s)
     return output
 
 def hampel_correcter(data, sample_rate, filtsize=6):
     '''Returns difference between data and large windowed hampel median filter.
-       Results in strong noise suppression, but relatively expensive to compute.
+       Results in strong noise suppression.
     '''
     return data - hampelfilt(data, filtsize=int(sample_rate))
 
 #Peak detection
-def detect_peaks(hrdata, rol_mean, ma_perc, sample_rate, update_dict=True):
+def detect_peaks(hrdata, rol_mean, ma_perc, sample_rate, update_dict=True, working_data=None):
     '''Detects heartrate peaks in the given dataset.
 
     Keyword arguments:
@@ -321,28 +502,21 @@ def detect_peaks(hrdata, rol_mean, ma_perc, sample_rate, update_dict=True):
     update_dict -- whether to update the peak information in the module's data structure
                    Setting this to False (default True) allows peak function to be re-used for
                    example by the breath analysis module.
+    working_data -- dict to store peak information in (default module-level working_data{})
+
+    Peak positions (and their values, 'ybeat') are numpy arrays. When update_dict is False
+    the array of peak positions is returned.
     '''
+    hrdata = np.asarray(hrdata)
     rmean = np.array(rol_mean)
-    rol_mean = rmean + ((rmean / 100) * ma_perc)
-    peaksx = np.where((hrdata > rol_mean))[0]
-    peaksy = hrdata[np.where((hrdata > rol_mean))[0]]
-    peakedges = np.concatenate((np.array([0]),
-                                (np.where(np.diff(peaksx) > 1)[0]),
-                                np.array([len(peaksx)])))
-    peaklist = []
-
-    for i in range(0, len(peakedges)-1):
-        try:
-            y_values = peaksy[peakedges[i]:peakedges[i+1]].tolist()
-            peaklist.append(peaksx[peakedges[i] + y_values.index(max(y_values))])
-        except:
-            pass
+    peaklist = detect_peaks_multi(hrdata, rmean, [ma_perc])[0]
 
     if update_dict:
+        working_data = _module_dict(working_data, 'working_data')
         working_data['peaklist'] = peaklist
-        working_data['ybeat'] = [hrdata[x] for x in peaklist]
-        working_data['rolmean'] = rol_mean
-        calc_rr(sample_rate)
+        working_data['ybeat'] = hrdata[peaklist]
+        working_data['rolmean'] = rmean + ((rmean / 100) * ma_perc)
+        calc_rr(sample_rate, working_data=working_data)
         if len(working_data['RR_list']):
             working_data['rrsd'] = np.std(working_data['RR_list'])
         else:
@@ -350,87 +524,224 @@ def detect_peaks(hrdata, rol_mean, ma_perc, sample_rate, update_dict=True):
     else:
         return peaklist
 
-def fit_peaks(hrdata, rol_mean, sample_rate, bpmmin=40, bpmmax=180):
+def detect_peaks_multi(hrdata, rol_mean, ma_perc_list, blocksize=2**20, artifact_mask=None):
+    '''Detects heartrate peaks for several peak detection thresholds at once.
+    Returns a list containing a numpy array of peak positions for every ma_perc.
+
+    Thresholds are evaluated together as a 2-dimensional (ma_perc x datapoints) matrix,
+    in blocks of at most 'blocksize' elements. Above-threshold segments of all thresholds
+    are then reduced to their peaks in a single pass.
+
+    Keyword arguments:
+    hrdata -- 1-dimensional numpy array containing the heart rate data
+    rol_mean -- 1-dimensional numpy array containing the rolling mean of the heart rate signal
+    ma_perc_list -- the percentages with which to raise the rolling mean
+    blocksize -- maximum number of threshold matrix elements evaluated at once (default 2**20)
+    artifact_mask -- boolean array marking samples (e.g. motion artifacts) that are never
+                     part of a peak, masked samples end above-threshold segments (default None)
+    '''
+    hrdata = np.asarray(hrdata)
+    rmean = np.array(rol_mean)
+    datalen = len(hrdata)
+    if artifact_mask is not None:
+        artifact_mask = np.asarray(artifact_mask, dtype=bool)
+    rows_per_block = max(1, blocksize // max(datalen, 1))
+    peaklists = []
+
+    for i in range(0, len(ma_perc_list), rows_per_block):
+        ma_percs = np.asarray(ma_perc_list[i:i + rows_per_block])
+        thresholds = rmean + ((rmean / 100) * ma_percs[:, None])
+        above = hrdata > thresholds
+        if artifact_mask is not None:
+            above &= ~artifact_mask
+        above = np.flatnonzero(above)
+        if len(above) == 0:
+            peaklists.extend([above] * len(ma_percs))
+            continue
+        rows = above // datalen
+        peaksx = above - (rows * datalen)
+        peaksy = hrdata[peaksx]
+
+        #like detect_peaks(), segments start at the start of every row and at the
+        #last above-threshold datapoint before every gap within a row
+        row_start = np.ones(len(above), dtype=bool)
+        row_start[1:] = rows[1:] != rows[:-1]
+        segment_start = row_start.copy()
+        segment_start[:-1] |= (np.diff(above) > 1) & ~row_start[1:]
+        segment_ids = np.cumsum(segment_start) - 1
+        segment_max = np.maximum.reduceat(peaksy, np.flatnonzero(segment_start))
+
+        #the peak of each segment is its first datapoint that equals the segment maximum
+        at_max = np.flatnonzero(peaksy == segment_max[segment_ids])
+        first_max = np.ones(len(at_max), dtype=bool)
+        first_max[1:] = segment_ids[at_max[1:]] != segment_ids[at_max[:-1]]
+        peaks = at_max[first_max]
+
+        counts = np.bincount(rows[peaks], minlength=len(ma_percs))
+        peaklists.extend(np.split(peaksx[peaks], np.cumsum(counts)[:-1]))
+    return peaklists
+
+def artifact_intervals(peaklist, artifact_mask):
+    '''Returns a boolean array marking the peak-peak intervals that contain masked samples.
+
+    Keyword arguments:
+    peaklist -- 1-dimensional numpy array or list containing the peak positions
+    artifact_mask -- boolean array marking artifact samples of the heart rate signal
+    '''
+    peaklist = np.asarray(peaklist, dtype=np.int64)
+    masked = np.concatenate(([0], np.cumsum(artifact_mask)))
+    return (masked[peaklist[1:] + 1] - masked[peaklist[:-1]]) > 0
+
+def fit_candidates(hrdata, rol_mean, sample_rate, artifact_mask=None):
+    '''Detects peaks at every threshold fit_peaks() chooses from. Returns a list holding a
+    (peaklist, rrsd, bpm, ma_perc) tuple per threshold.
+
+    The candidates don't depend on the BPM range, so they can be passed to fit_peaks()
+    for several ranges without detecting the peaks again.
+
+    Keyword arguments:
+    hrdata - 1-dimensional numpy array or list containing the heart rate data
+    rol_mean -- 1-dimensional numpy array containing the rolling mean of the heart rate signal
+    sample_rate -- the sample rate of the data set
+    artifact_mask -- boolean array marking artifact samples, see fit_peaks() (default None)
+    '''
+    hrdata = np.asarray(hrdata)
+    signal_len = len(hrdata)
+    if artifact_mask is not None:
+        artifact_mask = np.asarray(artifact_mask, dtype=bool)
+        signal_len -= np.count_nonzero(artifact_mask)
+    ma_perc_list = [5, 10, 15, 20, 25, 30, 40, 50, 60, 70, 80, 90, 100, 110, 120, 150, 200, 300]
+    peaklists = detect_peaks_multi(hrdata, rol_mean, ma_perc_list, artifact_mask=artifact_mask)
+    candidates = []
+    for peaklist, ma_perc in zip(peaklists, ma_perc_list):
+        fitted = peaklist
+        #same first peak removal as calc_rr()
+        if len(fitted) > 0 and fitted[0] <= ((sample_rate / 1000.0) * 150):
+            fitted = fitted[1:]
+        rr_list = (np.diff(fitted) / sample_rate) * 1000.0
+        if artifact_mask is not None:
+            rr_list = rr_list[~artifact_intervals(fitted, artifact_mask)]
+        _rrsd = np.std(rr_list) if len(rr_list) else np.inf
+        bpm = ((len(fitted)/(max(signal_len, 1)/sample_rate))*60)
+        candidates.append((peaklist, _rrsd, bpm, ma_perc))
+    return candidates
+
+def fit_peaks(hrdata, rol_mean, sample_rate, bpmmin=40, bpmmax=180, working_data=None,
+              artifact_mask=None, candidates=None):
     '''Runs fitting with varying peak detection thresholds given a heart rate signal.
        Results in relatively noise-robust, temporally accuract peak detection, as no
        non-linear transformations are involved that might shift peak positions.
 
+    All thresholds are evaluated together by detect_peaks_multi(), only the
+    best fitting solution is stored in working_data{}, next to the number of peaks,
+    RR standard deviation and BPM of every threshold ('fit_candidates').
+
     Keyword arguments:
     hrdata - 1-dimensional numpy array or list containing the heart rate data
     rol_mean -- 1-dimensional numpy array containing the rolling mean of the heart rate signal
     sample_rate -- the sample rate of the data set
     bpmmin -- minimum value of bpm to see as likely (default 40)
     bpmmax -- maximum value of bpm to see as likely (default 180)
+    working_data -- dict to store peak information in (default module-level working_data{})
+    artifact_mask -- boolean array marking artifact samples (e.g. motion) in which no peaks are
+                     searched. Intervals spanning artifacts are left out of the fit, and the
+                     mask is stored in working_data{} for the RR calculation (default None)
+    candidates -- result of fit_candidates() for the same data and artifact_mask, to choose
+                  from without detecting the peaks again (default None)
     '''
-    ma_perc_list = [5, 10, 15, 20, 25, 30, 40, 50, 60, 70, 80, 90, 100, 110, 120, 150, 200, 300]
-    rrsd = []
-    valid_ma = []
-    for ma_perc in ma_perc_list:
-        detect_peaks(hrdata, rol_mean, ma_perc, sample_rate)
-        bpm = ((len(working_data['peaklist'])/(len(hrdata)/sample_rate))*60)
-        rrsd.append([working_data['rrsd'], bpm, ma_perc])
+    working_data = _module_dict(working_data, 'working_data')
+    hrdata = np.asarray(hrdata)
+    if artifact_mask is not None:
+        artifact_mask = np.asarray(artifact_mask, dtype=bool)
+        working_data['artifact_mask'] = artifact_mask
+    if candidates is None:
+        candidates = fit_candidates(hrdata, rol_mean, sample_rate, artifact_mask=artifact_mask)
 
-    for _rrsd, _bpm, _ma_perc in rrsd:
+    valid_ma = []
+    for i, (_, _rrsd, _bpm, _ma_perc) in enumerate(candidates):
         if (_rrsd > 0.1) and ((bpmmin <= _bpm <= bpmmax)):
-            valid_ma.append([_rrsd, _ma_perc])
+            valid_ma.append([_rrsd, _ma_perc, i])
 
+    best_rrsd, best, best_index = min(valid_ma, key=lambda t: t[0])
+    working_data['fit_candidates'] = [
+        {'ma_perc': _ma_perc, 'peaks': len(peaklist), 'rrsd': float(_rrsd), 'bpm': float(_bpm)}
+        for peaklist, _rrsd, _bpm, _ma_perc in candidates]
+    rmean = np.array(rol_mean)
+    working_data['best'] = best
+    working_data['peaklist'] = candidates[best_index][0]
+    working_data['ybeat'] = hrdata[candidates[best_index][0]]
+    working_data['rolmean'] = rmean + ((rmean / 100) * best)
+    calc_rr(sample_rate, working_data=working_data)
+    working_data['rrsd'] = best_rrsd
 
-    working_data['best'] = min(valid_ma, key=lambda t: t[0])[1]
-    detect_peaks(hrdata, rol_mean, min(valid_ma, key=lambda t: t[0])[1], sample_rate)
+def check_peaks(reject_segmentwise=False, working_data=None):
+    '''Determines the best fit for peak detection variations run by fit_peaks().
 
-def check_peaks(reject_segmentwise=False):
-    '''Determines the best fit for peak detection variations run by fit_peaks().'''
+    Keyword arguments:
+    reject_segmentwise -- whether to reject 10-beat segments with too many rejected peaks
+    working_data -- dict holding the peak information (default module-level working_data{})
+    '''
+    working_data = _module_dict(working_data, 'working_data')
     rr_arr = np.array(working_data['RR_list'])
     peaklist = np.array(working_data['peaklist'])
     ybeat = np.array(working_data['ybeat'])
-    mean_rr = np.mean(rr_arr)
+    #intervals spanning artifacts say nothing about their peaks, update_rr() drops them
+    rr_artifacts = working_data.get('RR_artifacts', np.zeros(len(rr_arr), dtype=bool))
+    mean_rr = np.mean(rr_arr[~rr_artifacts]) if not np.all(rr_artifacts) else np.mean(rr_arr)
     upper_threshold = mean_rr + 300 if (0.3 * mean_rr) <= 300 else mean_rr + (0.3 * mean_rr)
     lower_threshold = mean_rr - 300 if (0.3 * mean_rr) <= 300 else mean_rr - (0.3 * mean_rr)
 
-    peaklist_cor = peaklist[np.where((rr_arr > lower_threshold) &
-                                     (rr_arr < upper_threshold))[0]+1]
-    working_data['peaklist_cor'] = np.insert(peaklist_cor, 0, peaklist[0])
-    working_data['removed_beats'] = peaklist[np.where((rr_arr <= lower_threshold) |
-                                                      (rr_arr >= upper_threshold))[0]+1]
-    working_data['removed_beats_y'] = ybeat[np.where((rr_arr <= lower_threshold) |
-                                                     (rr_arr >= upper_threshold))[0]+1]
-    working_data['binary_peaklist'] = [0 if x in working_data['removed_beats'] 
-                                       else 1 for x in working_data['peaklist']]
+    #RR interval i ends at peak i + 1, which is rejected along with the interval
+    outside = ((rr_arr <= lower_threshold) | (rr_arr >= upper_threshold)) & ~rr_artifacts
+    accepted = np.flatnonzero(~outside) + 1
+    rejected = np.flatnonzero(outside) + 1
+    working_data['peaklist_cor'] = np.insert(peaklist[accepted], 0, peaklist[0])
+    working_data['removed_beats'] = peaklist[rejected]
+    working_data['removed_beats_y'] = ybeat[rejected]
+    binary_peaklist = np.ones(len(peaklist), dtype=int)
+    binary_peaklist[rejected] = 0
+    working_data['binary_peaklist'] = binary_peaklist
     if(reject_segmentwise): 
-        check_binary_quality(working_data['binary_peaklist'])
-    update_rr()
+        check_binary_quality(working_data['binary_peaklist'], working_data=working_data)
+    update_rr(working_data=working_data)
 
-def check_binary_quality(binary_peaklist, maxrejects=3):
+def check_binary_quality(binary_peaklist, maxrejects=3, working_data=None):
     '''Checks signal in chunks of 10 beats. 
     Zeros out chunk if number of rejected peaks > maxrejects.
     Also marks rejected segment coordinates in tuples (x[0], x[1] in working_data['rejected_segments']
     
     Keyword arugments:
-    binary_peaklist: list with 0 and 1 corresponding to r-peak accept/reject decisions
+    binary_peaklist: numpy array or list with 0 and 1 corresponding to r-peak accept/reject
+                     decisions, rejected chunks are zeroed out in place
     maxrejects: int, maximum number of rejected peaks per 10-beat window (default 3)
+    working_data: dict holding the peak information (default module-level working_data{})
     '''
-    idx = 0
-    peaklist = working_data['peaklist']
-    working_data['rejected_segments'] = []
-    for i in range(int(len(binary_peaklist) / 10)):
-        if np.bincount(binary_peaklist[idx:idx + 10])[0] > maxrejects:
-            binary_peaklist[idx:idx + 10] = [0 for i in range(len(binary_peaklist[idx:idx+10]))]
-            if idx + 10 < len(peaklist): 
-                working_data['rejected_segments'].append((peaklist[idx], peaklist[idx + 10]))
-            else:
-                working_data['rejected_segments'].append((peaklist[idx], peaklist[-1]))
-        idx += 10
+    working_data = _module_dict(working_data, 'working_data')
+    peaklist = np.asarray(working_data['peaklist'])
+    binary = np.array(binary_peaklist)
+    chunks = binary[:(len(binary) // 10) * 10].reshape(-1, 10)
+    rejected_chunks = np.flatnonzero(np.sum(chunks == 0, axis=1) > maxrejects)
+    chunks[rejected_chunks] = 0
+    binary_peaklist[:] = binary
+
+    #a segment runs up to the first peak of the next chunk, or the last peak
+    starts = rejected_chunks * 10
+    ends = np.minimum(starts + 10, len(peaklist) - 1)
+    working_data['rejected_segments'] = list(zip(peaklist[starts], peaklist[ends]))
 
 #Calculating all measures
-def calc_rr(sample_rate):
+def calc_rr(sample_rate, working_data=None):
     '''Calculates the R-R (peak-peak) data required for further analysis.
 
     Uses calculated measures stored in the working_data{} dict to calculate
     all required peak-peak datasets. Stores results in the working_data{} dict.
+    Intervals that span samples of working_data['artifact_mask'] are marked in 'RR_artifacts'.
 
     Keyword arguments:
     sample_rate -- the sample rate of the data set
+    working_data -- dict holding the peak information (default module-level working_data{})
     '''
+    working_data = _module_dict(working_data, 'working_data')
     peaklist = np.array(working_data['peaklist'])
 
     #delete first peak if within first 150ms (signal might start mid-beat after peak)
@@ -443,23 +754,33 @@ def calc_rr(sample_rate):
     rr_list = (np.diff(peaklist) / sample_rate) * 1000.0
     rr_diff = np.abs(np.diff(rr_list))
     rr_sqdiff = np.power(rr_diff, 2)
+    if working_data.get('artifact_mask') is not None:
+        working_data['RR_artifacts'] = artifact_intervals(peaklist, working_data['artifact_mask'])
+    else:
+        working_data['RR_artifacts'] = np.zeros(len(rr_list), dtype=bool)
     working_data['RR_list'] = rr_list
     working_data['RR_diff'] = rr_diff
     working_data['RR_sqdiff'] = rr_sqdiff
 
-def update_rr():
+def update_rr(working_data=None):
     '''Updates RR differences and RR squared differences based on corrected RR list
 
     Uses information about rejected peaks to update RR_list_cor, and RR_diff, RR_sqdiff
     in the working_data{} dict.
+
+    Keyword arguments:
+    working_data -- dict holding the peak information (default module-level working_data{})
     '''
-    rr_source = working_data['RR_list']
-    b_peaks = working_data['binary_peaklist']
-    rr_list = [rr_source[i] for i in range(len(rr_source)) if b_peaks[i] + b_peaks[i+1] == 2]
-    rr_mask = [0 if (b_peaks[i] + b_peaks[i+1] == 2) else 1 for i in range(len(rr_source))]
-    rr_masked = np.ma.array(rr_source, mask=rr_mask)
-    rr_diff = np.abs(np.diff(rr_masked))
-    rr_diff = rr_diff[~rr_diff.mask]
+    working_data = _module_dict(working_data, 'working_data')
+    rr_source = np.asarray(working_data['RR_list'])
+    b_peaks = np.asarray(working_data['binary_peaklist'], dtype=bool)
+    #an RR interval is kept when the peaks on both sides were accepted and it spans no artifacts
+    rr_valid = b_peaks[:len(rr_source)] & b_peaks[1:len(rr_source) + 1]
+    if 'RR_artifacts' in working_data:
+        rr_valid &= ~working_data['RR_artifacts']
+    rr_list = rr_source[rr_valid]
+    rr_mask = (~rr_valid).astype(int)
+    rr_diff = np.abs(np.diff(rr_source))[rr_valid[:-1] & rr_valid[1:]]
     rr_sqdiff = np.power(rr_diff, 2)
     
     working_data['RR_masklist'] = rr_mask
@@ -467,13 +788,19 @@ def update_rr():
     working_data['RR_diff'] = rr_diff
     working_data['RR_sqdiff'] = rr_sqdiff
 
-def calc_ts_measures():
+def calc_ts_measures(working_data=None, measures=None):
     '''Calculates the time-series measurements.
 
     Uses calculated measures stored in the working_data{} dict to calculate
     the time-series measurements of the heart rate signal.
     Stores results in the measures{} dict object.
+
+    Keyword arguments:
+    working_data -- dict holding the peak information (default module-level working_data{})
+    measures -- dict to store the results in (default module-level measures{})
     '''
+    working_data = _module_dict(working_data, 'working_data')
+    measures = _module_dict(measures, 'measures')
     rr_list = working_data['RR_list_cor']
     rr_diff = working_data['RR_diff']
     rr_sqdiff = working_data['RR_sqdiff']
@@ -491,44 +818,76 @@ def calc_ts_measures():
     measures['pnn50'] = float(len(nn50)) / float(len(rr_diff))
     measures['hr_mad'] = MAD(rr_list)
 
-def calc_fd_measures(hrdata, sample_rate, method='welch'):
+def calc_fd_measures(hrdata, sample_rate, method='welch', working_data=None, measures=None,
+                     resample_rate=1000.0):
     '''Calculates the frequency-domain measurements.
 
     Uses calculated measures stored in the working_data{} dict to calculate
     the frequency-domain measurements of the heart rate signal.
     Stores results in the measures{} dict object.
+
+    For 'fft', 'periodogram' and 'welch' the RR intervals are interpolated with a spline
+    and resampled at resample_rate. 4Hz is common for HRV analysis and needs far less
+    memory and time than the default 1000Hz on long recordings. 'lomb' computes a
+    Lomb-Scargle periodogram directly on the irregularly spaced RR intervals instead,
+    at a frequency spacing of a quarter of the resolution of the series (1 / duration),
+    so its cost grows with the square of the duration: it suits short segments best.
+    'lf' and 'hf' sum the spectral density over their bands, for 'lomb' scaled to the
+    0.01Hz spacing of the 100 second welch segments.
+
+    Keyword arguments:
+    method -- 'fft', 'periodogram', 'welch' or 'lomb' (default 'welch')
+    working_data -- dict holding the peak information (default module-level working_data{})
+    measures -- dict to store the results in (default module-level measures{})
+    resample_rate -- rate in Hz to resample the interpolated RR intervals at (default 1000.0)
     '''
-    rr_list = working_data['RR_list_cor']
-    rr_x = []
-    pointer = 0
-    for x in rr_list:
-        pointer += x
-        rr_x.append(pointer)
-    rr_x_new = np.linspace(rr_x[0], rr_x[-1], rr_x[-1])
-    interpolated_func = UnivariateSpline(rr_x, rr_list, k=3)
-    
+    working_data = _module_dict(working_data, 'working_data')
+    measures = _module_dict(measures, 'measures')
+    rr_list = np.asarray(working_data['RR_list_cor'], dtype=np.float64)
+    rr_x = np.cumsum(rr_list)
+
+    if method=='lomb':
+        from scipy.signal import lombscargle
+        #peaks are about 1 / duration wide, sampling them 4 times as densely keeps their power
+        duration = (rr_x[-1] - rr_x[0]) / 1000.0
+        df = 1.0 / (4 * duration)
+        frq = np.arange(0.04, 0.5 + (df / 2), df)
+        power = lombscargle(rr_x / 1000.0, rr_list - np.mean(rr_list), 2 * np.pi * frq)
+        #scaled to a one-sided power spectral density like the other methods
+        psd = 2 * power / (len(rr_list) / duration)
+        #summed at the 0.01Hz spacing of welch, whatever the spacing of the grid
+        psd *= df / 0.01
+    else:
+        from scipy.interpolate import UnivariateSpline
+        rr_x_new = np.arange(rr_x[0], rr_x[-1], 1000.0 / resample_rate)
+        interpolated_func = UnivariateSpline(rr_x, rr_list, k=3)
+        measures['interp_rr_function'] = interpolated_func
+        measures['interp_rr_linspace'] = (rr_x[0], rr_x[-1], len(rr_x_new))
+
     if method=='fft':
         datalen = len(rr_x_new)
-        frq = np.fft.fftfreq(datalen, d=((1/1000.0)))
+        frq = np.fft.fftfreq(datalen, d=((1/resample_rate)))
         frq = frq[range(int(datalen/2))]
         Y = np.fft.fft(interpolated_func(rr_x_new))/datalen
         Y = Y[range(int(datalen/2))]
         psd = np.power(Y, 2)
     elif method=='periodogram':
-        frq, psd = periodogram(interpolated_func(rr_x_new), fs=1000.0)
+        from scipy.signal import periodogram
+        frq, psd = periodogram(interpolated_func(rr_x_new), fs=resample_rate)
     elif method=='welch':
-        frq, psd = welch(interpolated_func(rr_x_new), fs=1000.0, nperseg=100000)
-    else:
-        print("specified method incorrect, use 'fft', 'periodogram' or 'welch'")
+        from scipy.signal import welch
+        #100 second segments, regardless of the resample rate
+        frq, psd = welch(interpolated_func(rr_x_new), fs=resample_rate,
+                         nperseg=int(100 * resample_rate))
+    elif method!='lomb':
+        print("specified method incorrect, use 'fft', 'periodogram', 'welch' or 'lomb'")
         raise SystemExit(0)
     
-    measures['lf'] = np.trapz(abs(psd[(frq >= 0.04) & (frq <= 0.15)]))
-    measures['hf'] = np.trapz(abs(psd[(frq >= 0.16) & (frq <= 0.5)]))
+    measures['lf'] = _trapezoid(abs(psd[(frq >= 0.04) & (frq <= 0.15)]))
+    measures['hf'] = _trapezoid(abs(psd[(frq >= 0.16) & (frq <= 0.5)]))
     measures['lf/hf'] = measures['lf'] / measures['hf']
-    measures['interp_rr_function'] = interpolated_func
-    measures['interp_rr_linspace'] = (rr_x[0], rr_x[-1], rr_x[-1])
 
-def calc_breathing(sample_rate):
+def calc_breathing(sample_rate, working_data=None, measures=None):
     '''function to estimate breathing rate from heart rate signal.
     
     Upsamples the list of detected rr_intervals by interpolation
@@ -536,7 +895,12 @@ def calc_breathing(sample_rate):
 
     keyword arguments:
     sample_rate -- sample rate of the heart rate signal
+    working_data -- dict holding the peak information (default module-level working_data{})
+    measures -- dict to store the results in (default module-level measures{})
     '''
+    working_data = _module_dict(working_data, 'working_data')
+    measures = _module_dict(measures, 'measures')
+    from scipy.interpolate import UnivariateSpline
     rrlist = working_data['RR_list_cor']
     x = np.linspace(0, len(rrlist), len(rrlist))
     x_new = np.linspace(0, len(rrlist), len(rrlist)*10)
@@ -552,7 +916,52 @@ def calc_breathing(sample_rate):
         measures['breathingrate'] = np.nan
 
 #Plotting it
-def plotter(show=True, title='Heart Rate Signal Peak Detection', reject_segmentwise=False):
+def minmax_decimate(data, max_points):
+    '''Reduces a signal to at most max_points points for plotting, keeping its envelope.
+    Returns the sample positions and values of the points.
+
+    The signal is divided into max_points / 2 equally sized buckets, of which the minimum
+    and maximum are kept in their original order. Drawn at screen resolution the
+    decimated signal looks the same as the full signal.
+
+    Keyword arguments:
+    data -- 1-dimensional numpy array or list containing the signal
+    max_points -- maximum number of points to keep, e.g. twice the plot width in pixels
+    '''
+    data = np.asarray(data)
+    if len(data) <= max_points:
+        return np.arange(len(data)), data
+    bucketsize = int(np.ceil(len(data) / float(max(1, max_points // 2))))
+    usable = (len(data) // bucketsize) * bucketsize
+    buckets = data[:usable].reshape(-1, bucketsize)
+    offsets = np.arange(len(buckets)) * bucketsize
+    positions = [np.sort(np.stack((offsets + np.argmin(buckets, axis=1),
+                                   offsets + np.argmax(buckets, axis=1)), axis=1), axis=1).ravel()]
+    if usable < len(data):
+        tail = data[usable:]
+        positions.append(usable + np.unique([np.argmin(tail), np.argmax(tail)]))
+    positions = np.concatenate(positions)
+    return positions, data[positions]
+
+def _plot_peaks(ax, working_data, measures, title, reject_segmentwise, max_points):
+    '''Draws the signal and the accepted and rejected peaks on the passed matplotlib axes.'''
+    if max_points:
+        signal_x, signal_y = minmax_decimate(working_data['hr'], max_points)
+    else:
+        signal_x, signal_y = np.arange(len(working_data['hr'])), working_data['hr']
+    ax.set_title(title)
+    ax.plot(signal_x, signal_y, alpha=0.5, color='blue', label='heart rate signal')
+    ax.scatter(working_data['peaklist'], working_data['ybeat'], color='green',
+               label='BPM:%.2f' %(measures['bpm']))
+    ax.scatter(working_data['removed_beats'], working_data['removed_beats_y'], color='red',
+               label='rejected peaks')
+    if(reject_segmentwise):
+        for segment in working_data['rejected_segments']:
+            ax.axvspan(segment[0], segment[1], facecolor='red', alpha=0.5)
+    ax.legend(loc=4, framealpha=0.6)
+
+def plotter(show=True, title='Heart Rate Signal Peak Detection', reject_segmentwise=False,
+            working_data=None, measures=None, max_points=None):
     '''Plots the analysis results.
 
     Uses calculated measures and data stored in the working_data{} and measures{}
@@ -561,31 +970,104 @@ def plotter(show=True, title='Heart Rate Signal Peak Detection', reject_segmentw
     Keyword arguments:
     show -- whether to display the plot (True) or return a plot object (False) (default True)
     title -- the title used in the plot
+    working_data -- dict holding the analysis results (default module-level working_data{})
+    measures -- dict holding the measures (default module-level measures{})
+    max_points -- plot the signal decimated to at most this many points, see
+                  minmax_decimate() (default None, plots every sample)
     '''
     import matplotlib.pyplot as plt
-    peaklist = working_data['peaklist']
-    ybeat = working_data['ybeat']
-    rejectedpeaks = working_data['removed_beats']
-    rejectedpeaks_y = working_data['removed_beats_y']
-    plt.title(title)
-    plt.plot(working_data['hr'], alpha=0.5, color='blue', label='heart rate signal')
-    plt.scatter(peaklist, ybeat, color='green', label='BPM:%.2f' %(measures['bpm']))
-    plt.scatter(rejectedpeaks, rejectedpeaks_y, color='red', label='rejected peaks')
-    if(reject_segmentwise):
-        for segment in working_data['rejected_segments']:
-            plt.axvspan(segment[0], segment[1], facecolor='red', alpha=0.5)
-    plt.legend(loc=4, framealpha=0.6)
+    working_data = _module_dict(working_data, 'working_data')
+    measures = _module_dict(measures, 'measures')
+    _plot_peaks(plt.gca(), working_data, measures, title, reject_segmentwise, max_points)
     if show:
         plt.show()
     else:
         return plt
 
+def save_plot(filename, title='Heart Rate Signal Peak Detection', reject_segmentwise=False,
+              working_data=None, measures=None, width=16, height=4, dpi=100, max_points=None):
+    '''Renders the analysis results like plotter() straight to an image file, without
+    pyplot or a display. The format follows the extension of filename, e.g. PNG or SVG.
+
+    The figure is not registered with pyplot, so plots can be rendered from worker
+    processes and threads and are freed as soon as they are saved.
+
+    Keyword arguments:
+    filename -- path of the image file to write
+    title -- the title used in the plot
+    working_data -- dict holding the analysis results (default module-level working_data{})
+    measures -- dict holding the measures (default module-level measures{})
+    width -- figure width in inches (default 16)
+    height -- figure height in inches (default 4)
+    dpi -- resolution in dots per inch (default 100)
+    max_points -- decimate the signal to at most this many points (default twice the
+                  figure width in pixels)
+    '''
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    working_data = _module_dict(working_data, 'working_data')
+    measures = _module_dict(measures, 'measures')
+    if max_points is None:
+        max_points = 2 * int(width * dpi)
+    fig = Figure(figsize=(width, height), dpi=dpi)
+    FigureCanvasAgg(fig)
+    _plot_peaks(fig.add_subplot(111), working_data, measures, title, reject_segmentwise,
+                max_points)
+    fig.savefig(filename)
+
 #Wrapper function
+def _process_peaks(hrdata, sample_rate, windowsize, interp_clipping, clipping_scale,
+                   interp_threshold, hampel_correct, bpmmin, bpmmax, reject_segmentwise,
+                   working_data, profile=None, artifact_mask=None):
+    '''Runs the preprocessing, peak fitting and peak rejection stages shared by process()
+    and process_segmentwise(). Returns the preprocessed heart rate data.'''
+    if profile is None:
+        profile = NullProfile()
+    if interp_clipping:
+        with profile.stage('interpolate_clipping') as record:
+            if clipping_scale:
+                hrdata = scale_data(hrdata)
+            hrdata = interpolate_peaks(hrdata, sample_rate, threshold=interp_threshold,
+                                       working_data=working_data)
+            record['clipping_count'] = working_data['clipping_count']
+            record['arrays'] = array_sizes(hr=hrdata)
+
+    if hampel_correct:
+        with profile.stage('hampel_correct') as record:
+            hrdata = enhance_peaks(hrdata)
+            hrdata = hampel_correcter(hrdata, sample_rate, filtsize=sample_rate)
+            record['arrays'] = array_sizes(hr=hrdata)
+
+    working_data['hr'] = hrdata
+    working_data['sample_rate'] = sample_rate
+    with profile.stage('rolmean') as record:
+        rol_mean = rolmean(hrdata, windowsize, sample_rate)
+        record['arrays'] = array_sizes(rolmean=rol_mean)
+    with profile.stage('fit_peaks') as record:
+        fit_peaks(hrdata, rol_mean, sample_rate, bpmmin=bpmmin, bpmmax=bpmmax,
+                  working_data=working_data, artifact_mask=artifact_mask)
+        record['best'] = working_data['best']
+        record['candidates'] = working_data['fit_candidates']
+        record['arrays'] = array_sizes(peaklist=working_data['peaklist'])
+    with profile.stage('calc_rr') as record:
+        calc_rr(sample_rate, working_data=working_data)
+        record['arrays'] = array_sizes(RR_list=working_data['RR_list'])
+    with profile.stage('check_peaks') as record:
+        check_peaks(reject_segmentwise, working_data=working_data)
+        record['arrays'] = array_sizes(RR_list_cor=working_data['RR_list_cor'])
+    return hrdata
+
 def process(hrdata, sample_rate, windowsize=0.75, report_time=False, 
             calc_freq=False, freq_method='welch', interp_clipping=True, clipping_scale=False,
             interp_threshold=1020, hampel_correct=False, bpmmin=40, bpmmax=180,
-            reject_segmentwise=False):
-    '''Processed the passed heart rate data. Returns measures{} dict containing results.
+            reject_segmentwise=False, working_data=None, measures=None, freq_resample_rate=1000.0,
+            profile=None, artifact_mask=None):
+    '''Processed the passed heart rate data. Returns measures{} dict containing results,
+    or a (measures{}, Profile) tuple when profiling.
+
+    Every call works on its own working_data{} and measures{} dicts, so calls can safely
+    run concurrently from multiple threads. When finished, the results are also copied
+    into the module-level dicts for functions like plotter() that are called without dicts.
 
     Keyword arguments:
     hrdata -- 1-dimensional numpy array or list containing heart rate data
@@ -593,40 +1075,188 @@ def process(hrdata, sample_rate, windowsize=0.75, report_time=False,
     windowsize -- the window size to use, in seconds (calculated as windowsize * sample_rate)
     report_time -- whether to report total processing time of algorithm (default True)
     calc_freq -- whether to compute time-series measurements (default False)
+    freq_method -- method for frequency domain measures: 'fft', 'periodogram', 'welch'
+                   or 'lomb' (default 'welch')
+    freq_resample_rate -- rate in Hz at which RR intervals are resampled for frequency domain
+                          measures, 4Hz is common for HRV analysis (default 1000.0)
     interp_clipping -- whether to detect and interpolate clipping segments of the signal 
                        (default True)
     intep_threshold -- threshold to use to detect clipping segments. Recommended to be a few
                        datapoints below the sensor or ADC's maximum value (to account for
                        slight data line noise). Default 1020, 4 below max of 1024 for 10-bit ADC
     hampel_correct -- whether to reduce noisy segments using large median filter. Disabled by
-                      default due to computational complexity, and generally it is not necessary
+                      default, generally it is not necessary
     bpmmin -- minimum value to see as likely for BPM when fitting peaks
     bpmmax -- maximum value to see as likely for BPM when fitting peaks
+    working_data -- dict to store intermediate results in (default new dict)
+    measures -- dict to store the measures in (default new dict)
+    profile -- True or a heartbeat.profiling.Profile to record the time, peak memory
+               allocation and array sizes of every stage, see Profile for sinks (default None)
+    artifact_mask -- boolean array, True for samples with (motion) artifacts. No peaks are
+                     searched there and RR intervals spanning them are left out, see
+                     fit_peaks(). The masked duration is reported as 'artifact_duration'
+                     (default None)
     '''
-    t1 = time.clock()
-
+    if working_data is None:
+        working_data = {}
+    if measures is None:
+        measures = {}
+    profiling = profile is not None and profile is not False
+    if profile is True:
+        profile = Profile()
+    elif not profiling:
+        profile = NullProfile()
+    t1 = time.perf_counter()
+
+    hrdata = _process_peaks(hrdata, sample_rate, windowsize, interp_clipping, clipping_scale,
+                            interp_threshold, hampel_correct, bpmmin, bpmmax,
+                            reject_segmentwise, working_data, profile, artifact_mask)
+    with profile.stage('calc_ts_measures'):
+        calc_ts_measures(working_data=working_data, measures=measures)
+    with profile.stage('calc_breathing'):
+        calc_breathing(sample_rate, working_data=working_data, measures=measures)
     if interp_clipping:
-        if clipping_scale:
-            hrdata = scale_data(hrdata)
-        hrdata = interpolate_peaks(hrdata, sample_rate, threshold=interp_threshold)
-
-    if hampel_correct:
-        hrdata = enhance_peaks(hrdata)
-        hrdata = hampel_correcter(hrdata, sample_rate, filtsize=sample_rate)
-
-    working_data['hr'] = hrdata
-    rol_mean = rolmean(hrdata, windowsize, sample_rate)
-    fit_peaks(hrdata, rol_mean, sample_rate)
-    calc_rr(sample_rate)
-    check_peaks(reject_segmentwise)
-    calc_ts_measures()
-    calc_breathing(sample_rate)
+        measures['clipping_count'] = working_data['clipping_count']
+        measures['clipping_duration'] = working_data['clipping_duration']
+    if artifact_mask is not None:
+        measures['artifact_duration'] = np.count_nonzero(artifact_mask) / sample_rate
     if calc_freq:
-        calc_fd_measures(hrdata, sample_rate)
+        with profile.stage('calc_fd_measures', method=freq_method):
+            calc_fd_measures(hrdata, sample_rate, method=freq_method, working_data=working_data,
+                             measures=measures, resample_rate=freq_resample_rate)
     if report_time:
-        print('\nFinished in %.8s sec' %(time.clock()-t1))
+        print('\nFinished in %.8s sec' %(time.perf_counter()-t1))
+
+    _update_module_dicts(working_data, measures)
+    if profiling:
+        return measures, profile
     return measures
 
+def process_segmentwise(hrdata, sample_rate, segment_width=120, segment_overlap=0,
+                        windowsize=0.75, calc_freq=False, freq_method='lomb',
+                        freq_resample_rate=4.0, interp_clipping=True, clipping_scale=False,
+                        interp_threshold=1020, hampel_correct=False, bpmmin=40, bpmmax=180,
+                        reject_segmentwise=False, working_data=None, artifact_mask=None):
+    '''Processes the passed heart rate data in (overlapping) segments. Returns a dict with a
+    numpy array for every measure, holding one value per segment.
+
+    Peaks are fitted and checked once over the full signal. The time-series measures of all
+    segments are then taken from cumulative sums over the shared RR intervals, breathing rate
+    and frequency domain measures from each segment's share of the RR intervals. An RR
+    interval belongs to a segment when both its peaks lie within the segment. Measures of
+    segments with too few accepted RR intervals are NaN, as are the frequency domain
+    measures of segments shorter than 25 seconds, one cycle of the lowest LF frequency.
+
+    Keyword arguments:
+    hrdata -- 1-dimensional numpy array or list containing heart rate data
+    sample_rate -- the sample rate of the heart rate data
+    segment_width -- the width of the segments, in seconds (default 120)
+    segment_overlap -- fraction of overlap between consecutive segments, e.g. 60 second
+                       segments every 10 seconds have an overlap of 5/6 (default 0)
+    calc_freq -- whether to compute frequency domain measurements (default False)
+    freq_method -- method for frequency domain measures, see calc_fd_measures()
+                   (default 'lomb', needs no interpolation of the short segments)
+    freq_resample_rate -- rate in Hz at which RR intervals are resampled for frequency domain
+                          measures (default 4.0)
+    working_data -- dict to store the peak information of the full signal in (default new dict)
+
+    The other keyword arguments are the same as those of process().
+    '''
+    if working_data is None:
+        working_data = {}
+    hrdata = _process_peaks(hrdata, sample_rate, windowsize, interp_clipping, clipping_scale,
+                            interp_threshold, hampel_correct, bpmmin, bpmmax,
+                            reject_segmentwise, working_data, artifact_mask=artifact_mask)
+
+    segment_len = int(segment_width * sample_rate)
+    segment_step = max(1, int(round(segment_width * (1 - segment_overlap) * sample_rate)))
+    seg_starts = np.arange(0, len(hrdata) - segment_len + 1, segment_step)
+    seg_ends = seg_starts + segment_len
+    return segment_measures(seg_starts, seg_ends, sample_rate, working_data=working_data,
+                            calc_freq=calc_freq, freq_method=freq_method,
+                            freq_resample_rate=freq_resample_rate)
+
+def segment_measures(seg_starts, seg_ends, sample_rate, working_data=None, calc_freq=False,
+                     freq_method='lomb', freq_resample_rate=4.0):
+    '''Computes measures for arbitrary segments of an already processed signal. Returns a
+    dict with a numpy array for every measure, holding one value per segment.
+
+    The segments slice the peaks, RR intervals and signal in working_data{} as fitted and
+    checked over the full signal by process() or process_segmentwise(), nothing is fitted
+    again. See process_segmentwise() for how intervals are assigned to segments and which
+    segments get NaN measures.
+
+    Keyword arguments:
+    seg_starts -- first sample of every segment
+    seg_ends -- end of every segment (exclusive), in samples
+    sample_rate -- the sample rate of the heart rate data
+    working_data -- dict holding the peak information of the full signal
+                    (default module-level working_data{})
+    calc_freq -- whether to compute frequency domain measurements (default False)
+    freq_method -- method for frequency domain measures, see calc_fd_measures() (default 'lomb')
+    freq_resample_rate -- rate in Hz at which RR intervals are resampled for frequency domain
+                          measures (default 4.0)
+    '''
+    working_data = _module_dict(working_data, 'working_data')
+    hrdata = np.asarray(working_data['hr'])
+    seg_starts = np.asarray(seg_starts, dtype=np.int64)
+    seg_ends = np.asarray(seg_ends, dtype=np.int64)
+
+    #RR interval i runs from peak i to peak i + 1
+    peaklist = np.asarray(working_data['peaklist'])
+    rr_list = np.asarray(working_data['RR_list'], dtype=np.float64)
+    rr_valid = ~np.asarray(working_data['RR_masklist'], dtype=bool)
+    rr_diff_valid = rr_valid[:-1] & rr_valid[1:]
+    rr_sqdiff = np.power(np.diff(rr_list), 2)
+    rr_start = np.searchsorted(peaklist, seg_starts)
+    rr_end = np.maximum(np.searchsorted(peaklist, seg_ends) - 1, rr_start)
+    rr_diff_end = np.maximum(rr_end - 1, rr_start)
+
+    def segment_sums(values, valid, end):
+        cumsum = np.concatenate(([0], np.cumsum(np.where(valid, values, 0))))
+        return cumsum[end] - cumsum[rr_start]
+
+    #sums around the overall mean RR interval keep the variances accurate
+    rr_center = np.mean(rr_list[rr_valid]) if np.any(rr_valid) else 0
+    rr_count = segment_sums(1, rr_valid, rr_end)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rr_mean = segment_sums(rr_list - rr_center, rr_valid, rr_end) / rr_count
+        rr_var = segment_sums(np.power(rr_list - rr_center, 2), rr_valid, rr_end) / rr_count
+        rr_var -= np.power(rr_mean, 2)
+        rr_mean += rr_center
+        rr_sqdiff_mean = (segment_sums(rr_sqdiff, rr_diff_valid, rr_diff_end) /
+                          segment_sums(1, rr_diff_valid, rr_diff_end))
+
+        seg_measures = {}
+        seg_measures['segment_start'] = seg_starts / sample_rate
+        seg_measures['segment_end'] = seg_ends / sample_rate
+        seg_measures['bpm'] = 60000 / rr_mean
+        seg_measures['ibi'] = rr_mean
+        seg_measures['sdnn'] = np.sqrt(np.maximum(rr_var, 0))
+        seg_measures['rmssd'] = np.sqrt(rr_sqdiff_mean)
+
+    #breathing rate needs 0.75 seconds of RR intervals at its 100Hz upsampling
+    breathing_min_rr = int(np.ceil(0.75 * 100.0 / 10))
+    #the LF band needs one cycle of its lowest frequency, shorter segments resolve it in one point
+    fd_min_samples = sample_rate / 0.04
+    fd_keys = ['lf', 'hf', 'lf/hf'] if calc_freq else []
+    for key in ['breathingrate'] + fd_keys:
+        seg_measures[key] = np.full(len(seg_starts), np.nan)
+    for i in range(len(seg_starts)):
+        segment_rr = rr_list[rr_start[i]:rr_end[i]][rr_valid[rr_start[i]:rr_end[i]]]
+        segment_data = {'RR_list_cor': segment_rr, 'hr': hrdata[seg_starts[i]:seg_ends[i]]}
+        measures = {}
+        if len(segment_rr) >= breathing_min_rr:
+            calc_breathing(sample_rate, working_data=segment_data, measures=measures)
+        if calc_freq and len(segment_rr) >= 4 and seg_ends[i] - seg_starts[i] >= fd_min_samples:
+            calc_fd_measures(segment_data['hr'], sample_rate, method=freq_method,
+                             working_data=segment_data, measures=measures,
+                             resample_rate=freq_resample_rate)
+        for key in measures:
+            if key in seg_measures:
+                seg_measures[key][i] = measures[key]
+    return seg_measures
+
 if __name__ == '__main__':
     hrdata = get_data('data.csv')
     fs = 100.0
@@ -0,0 +1,110 @@
+'''Butterworth filter bank in second-order sections (SOS) form.
+
+Designs are cached by (cutoff, sample_rate, order, btype), so filtering many recordings
+at the same rate designs every filter once. Second-order sections stay numerically
+stable at high orders and low cutoffs, where the transfer function (b, a) form loses
+precision. Zero-phase filtering can run in overlapping chunks to bound the memory
+used on multi-hour recordings.
+'''
+
+from functools import lru_cache
+
+import numpy as np
+
+#chunked filtering keeps the edges of every chunk until the filter's impulse response
+#has decayed to this fraction, which bounds the difference with whole-array filtering
+SETTLE_TOLERANCE = 1e-10
+
+#results narrower than float64 are filtered in chunks of at most this many samples, also when
+#the data is shorter than a chunk, so the float64 work doesn't outgrow the result itself
+NARROW_CHUNKSIZE = 2**16
+
+@lru_cache(maxsize=128)
+def _design(cutoff, sample_rate, order, btype):
+    from scipy.signal import butter
+    nyq = 0.5 * sample_rate
+    normal_cutoff = np.asarray(cutoff, dtype=np.float64) / nyq
+    return butter(order, normal_cutoff, btype=btype, analog=False, output='sos')
+
+def design_filter(cutoff, sample_rate, order=2, btype='low'):
+    '''Returns the second-order sections of a Butterworth filter, a copy of the cached design.
+
+    Keyword arguments:
+    cutoff -- the cutoff frequency, or a (low, high) pair of frequencies for 'band'
+    sample_rate -- the sample rate of the data set
+    order -- the filter order (default 2)
+    btype -- 'low', 'high' or 'band' (default 'low')
+    '''
+    if np.ndim(cutoff):
+        cutoff = tuple(float(c) for c in cutoff)
+    else:
+        cutoff = float(cutoff)
+    return _design(cutoff, float(sample_rate), int(order), btype).copy()
+
+def settle_length(sos, tolerance=SETTLE_TOLERANCE):
+    '''Returns the number of samples after which the impulse response of the filter has
+    decayed to 'tolerance', estimated from its slowest pole.'''
+    from scipy.signal import sos2zpk
+    _, poles, _ = sos2zpk(sos)
+    radius = np.max(np.abs(poles)) if len(poles) else 0.0
+    if radius <= 0:
+        return 1
+    return int(np.ceil(np.log(tolerance) / np.log(radius))) + 1
+
+def sosfiltfilt_chunked(sos, data, chunksize=2**20, dtype=np.float64):
+    '''Zero-phase filters data with second-order sections, in chunks of 'chunksize' samples.
+
+    Every chunk is filtered forward and backward together with settle_length() samples on
+    both sides, which are then discarded, so the result matches filtering the whole array
+    within SETTLE_TOLERANCE of the signal amplitude. Memory use is bounded by the chunk
+    size instead of the length of the data. Data shorter than a chunk is filtered at once.
+    Chunks are always filtered in float64, the result is stored in 'dtype'. For a narrower
+    'dtype' (e.g. float32) chunks are at most NARROW_CHUNKSIZE samples, so the peak memory
+    is about that of the result instead of that of a float64 copy of the data.
+
+    Keyword arguments:
+    sos -- second-order sections, e.g. from design_filter()
+    data -- 1-dimensional numpy array or list containing the to be filtered data
+    chunksize -- number of output samples per chunk (default 2**20)
+    dtype -- floating point type of the result, e.g. np.float32 (default float64)
+    '''
+    from scipy.signal import sosfiltfilt
+    data = np.asarray(data)
+    if np.dtype(dtype).itemsize < 8:
+        chunksize = min(chunksize, NARROW_CHUNKSIZE)
+    if len(data) <= chunksize:
+        return sosfiltfilt(sos, data.astype(np.float64, copy=False)).astype(dtype, copy=False)
+
+    margin = settle_length(sos)
+    filtered = np.empty(len(data), dtype=dtype)
+    for start in range(0, len(data), chunksize):
+        end = min(start + chunksize, len(data))
+        lo = max(start - margin, 0)
+        hi = min(end + margin, len(data))
+        chunk = sosfiltfilt(sos, data[lo:hi].astype(np.float64, copy=False))
+        filtered[start:end] = chunk[start - lo:end - lo]
+    return filtered
+
+def filter_signal(data, cutoff, sample_rate, order=2, btype='low', chunksize=2**20, dtype=np.float64):
+    '''Applies a zero-phase Butterworth filter from the filter bank.
+
+    Keyword arguments:
+    data -- 1-dimensional numpy array or list containing the to be filtered data
+    cutoff -- the cutoff frequency, or a (low, high) pair of frequencies for 'band'
+    sample_rate -- the sample rate of the data set
+    order -- the filter order (default 2)
+    btype -- 'low', 'high' or 'band' (default 'low')
+    chunksize -- number of samples filtered at once, see sosfiltfilt_chunked() (default 2**20)
+    dtype -- floating point type of the result, e.g. np.float32 (default float64)
+    '''
+    sos = design_filter(cutoff, sample_rate, order, btype)
+    return sosfiltfilt_chunked(sos, data, chunksize=chunksize, dtype=dtype)
+
+def highpass_filter(data, cutoff, sample_rate, order=2, chunksize=2**20, dtype=np.float64):
+    '''Removes baseline wander below 'cutoff' Hz with a zero-phase Butterworth highpass filter.'''
+    return filter_signal(data, cutoff, sample_rate, order, 'high', chunksize, dtype)
+
+def bandpass_filter(data, lowcut, highcut, sample_rate, order=2, chunksize=2**20, dtype=np.float64):
+    '''Keeps frequencies between 'lowcut' and 'highcut' Hz with a zero-phase Butterworth
+    bandpass filter, removing baseline wander and high frequency noise at once.'''
+    return filter_signal(data, (lowcut, highcut), sample_rate, order, 'band', chunksize, dtype)
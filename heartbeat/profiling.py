@@ -0,0 +1,123 @@
+'''Opt-in timing and memory instrumentation of the stages of process().
+
+A Profile collects one record per stage, holding its wall time (perf_counter), its peak
+memory allocation (tracemalloc) and the sizes of the arrays it produced. Every record is
+passed to the sinks as soon as the stage finishes, so a long batch run can be followed
+while it runs, e.g. with jsonlines_sink().
+'''
+
+from contextlib import contextmanager
+import json
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+#tracemalloc is global to the interpreter, stages that trace memory take turns
+_memory_lock = threading.Lock()
+
+class Profile(object):
+    '''Collects the records of profiled stages in the 'stages' list.
+
+    Keyword arguments:
+    sinks -- callables that are passed every record (a dict) when its stage finishes
+    trace_memory -- whether to record peak memory allocation with tracemalloc, which
+                    slows down the profiled stages (default True)
+    context -- any other keyword arguments are added to every record, e.g. file='record_1.csv'
+
+    tracemalloc traces the whole interpreter, so stages that trace memory run one at a
+    time, also when profiled process() calls run in several threads. Allocations by other
+    threads that aren't in a traced stage, e.g. unprofiled calls, still count towards the
+    peak memory of a stage. Use trace_memory=False to profile concurrent calls without
+    waiting for each other.
+    '''
+    def __init__(self, sinks=None, trace_memory=True, **context):
+        self.sinks = list(sinks or [])
+        self.trace_memory = trace_memory
+        self.context = context
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, **info):
+        '''Context manager that profiles the code it wraps as stage 'name'. Yields the
+        record of the stage, to which more information (e.g. array_sizes()) can be added.'''
+        record = dict(self.context, stage=name, **info)
+        if not self.trace_memory:
+            t1 = time.perf_counter()
+            try:
+                yield record
+            finally:
+                record['seconds'] = time.perf_counter() - t1
+                self.add(record)
+            return
+
+        with _memory_lock:
+            start_tracing = not tracemalloc.is_tracing()
+            if start_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+            t1 = time.perf_counter()
+            try:
+                yield record
+            finally:
+                record['seconds'] = time.perf_counter() - t1
+                record['peak_memory'] = tracemalloc.get_traced_memory()[1] - memory_start
+                if start_tracing:
+                    tracemalloc.stop()
+        self.add(record)
+
+    def add(self, record):
+        '''Stores a record and passes it to the sinks.'''
+        self.stages.append(record)
+        for sink in self.sinks:
+            sink(record)
+
+    @property
+    def total(self):
+        '''Total seconds spent in the profiled stages.'''
+        return sum(record['seconds'] for record in self.stages)
+
+    def summary(self):
+        '''Returns a dict with the seconds spent in every stage.'''
+        seconds = {}
+        for record in self.stages:
+            seconds[record['stage']] = seconds.get(record['stage'], 0) + record['seconds']
+        return seconds
+
+class NullProfile(Profile):
+    '''Profile that records nothing, used when profiling is disabled.'''
+    def __init__(self):
+        Profile.__init__(self, trace_memory=False)
+
+    @contextmanager
+    def stage(self, name, **info):
+        yield {}
+
+def array_sizes(**arrays):
+    '''Returns the shape and size in bytes of every passed array, by keyword.'''
+    sizes = {}
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        sizes[name] = {'shape': list(array.shape), 'nbytes': int(array.nbytes)}
+    return sizes
+
+def _to_builtin(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+def jsonlines_sink(filename):
+    '''Returns a sink that appends every record to 'filename' as one line of JSON.
+
+    Each record is written with a single append, so the sinks of several processes
+    can share a file.
+    '''
+    def sink(record):
+        line = json.dumps(record, default=_to_builtin) + '\n'
+        with open(filename, 'a') as f:
+            f.write(line)
+    return sink
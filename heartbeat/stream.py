@@ -0,0 +1,117 @@
+'''Causal, online heart beat detection for samples that arrive in chunks,
+e.g. straight from the Arduino during an experiment.
+
+Unlike process(), nothing here needs the full signal: the lowpass filter keeps
+its state between chunks, the rolling mean only keeps its last window of samples,
+and beats are emitted as soon as the signal drops back below the threshold.
+'''
+
+import numpy as np
+
+from .filtering import design_filter
+
+class StreamingPeakDetector(object):
+    '''Detects heart beats and instantaneous BPM in a stream of samples.
+
+    Peak detection follows detect_peaks(): the threshold is the rolling mean raised by
+    ma_perc percent, and the peak of every segment above it is a beat. Use update()
+    for every chunk of samples, memory use stays constant however long the stream runs.
+
+    Keyword arguments:
+    sample_rate -- the (nominal) sample rate of the stream
+    cutoff -- cutoff frequency of the causal Butterworth lowpass filter (default sample_rate / 4)
+    order -- the filter order (default 3)
+    windowsize -- the rolling mean window, in seconds (default 0.75)
+    ma_perc -- the percentage with which to raise the rolling mean, e.g. the best
+               fit ('best' in working_data{}) of an earlier offline analysis (default 20)
+    bpmmin -- BPM below which the interval to the previous beat is considered a gap,
+              reported as NaN BPM (default 40)
+    bpmmax -- BPM above which a beat is too close to the previous one and skipped (default 180)
+    '''
+    def __init__(self, sample_rate, cutoff=None, order=3, windowsize=0.75, ma_perc=20,
+                 bpmmin=40, bpmmax=180):
+        if cutoff is None:
+            cutoff = np.floor(sample_rate / 4)
+        self.sample_rate = sample_rate
+        self.ma_perc = ma_perc
+        self.min_interval = 60000.0 / bpmmax
+        self.max_interval = 60000.0 / bpmmin
+        self._sos = design_filter(cutoff, sample_rate, order, 'low')
+        self._windowlen = max(1, int(windowsize * sample_rate))
+        self.reset()
+
+    def reset(self):
+        '''Forgets all state, the next chunk is treated as the start of a new stream.'''
+        self._zi = None
+        self._window = np.zeros(0)
+        self._in_segment = False
+        self._segment_max = None
+        self._segment_time = None
+        self._last_beat = None
+
+    def update(self, timestamps, voltages):
+        '''Processes a chunk of samples. Returns a tuple of numpy arrays with the
+        timestamps of the beats completed in this chunk and their instantaneous BPM.
+
+        Keyword arguments:
+        timestamps -- 1-dimensional array of sample timestamps, in ms (e.g. unix_timestamp)
+        voltages -- 1-dimensional array of heart rate voltages, same length as timestamps
+        '''
+        from scipy.signal import sosfilt, sosfilt_zi
+        timestamps = np.asarray(timestamps)
+        voltages = np.asarray(voltages, dtype=np.float64)
+        if len(voltages) == 0:
+            return timestamps[:0], np.zeros(0)
+
+        if self._zi is None:
+            #start the filter in steady state at the first sample
+            self._zi = sosfilt_zi(self._sos) * voltages[0]
+        filtered, self._zi = sosfilt(self._sos, voltages, zi=self._zi)
+
+        #trailing rolling mean over the buffered window followed by this chunk
+        history = np.concatenate((self._window, filtered))
+        cumsum = np.concatenate(([0], np.cumsum(history)))
+        positions = np.arange(len(self._window), len(history))
+        window_start = np.maximum(positions + 1 - self._windowlen, 0)
+        rol_mean = ((cumsum[positions + 1] - cumsum[window_start]) /
+                    (positions + 1 - window_start))
+        self._window = history[max(0, len(history) - self._windowlen + 1):].copy()
+
+        threshold = rol_mean + ((rol_mean / 100) * self.ma_perc)
+        edges = np.diff(np.concatenate(([0], filtered > threshold, [0])).astype(np.int8))
+        run_starts = np.flatnonzero(edges == 1)
+        run_ends = np.flatnonzero(edges == -1)
+
+        peak_times = []
+        if self._in_segment and (len(run_starts) == 0 or run_starts[0] != 0):
+            #segment ended exactly at the end of the previous chunk
+            peak_times.append(self._segment_time)
+            self._in_segment = False
+        for start, end in zip(run_starts, run_ends):
+            peak = start + np.argmax(filtered[start:end])
+            peak_max, peak_time = filtered[peak], timestamps[peak]
+            if start == 0 and self._in_segment and self._segment_max >= peak_max:
+                peak_max, peak_time = self._segment_max, self._segment_time
+            if end == len(filtered):
+                #segment still open, its peak may lie in the next chunk
+                self._in_segment = True
+                self._segment_max, self._segment_time = peak_max, peak_time
+            else:
+                self._in_segment = False
+                peak_times.append(peak_time)
+
+        beats = []
+        bpm = []
+        for peak_time in peak_times:
+            if self._last_beat is None:
+                beats.append(peak_time)
+                bpm.append(np.nan)
+                self._last_beat = peak_time
+                continue
+            interval = float(peak_time - self._last_beat)
+            if interval < self.min_interval:
+                continue
+            beats.append(peak_time)
+            bpm.append(60000.0 / interval if interval <= self.max_interval else np.nan)
+            self._last_beat = peak_time
+        return np.array(beats, dtype=timestamps.dtype), np.array(bpm)
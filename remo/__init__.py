@@ -0,0 +1,10 @@
+# Loading and analysis of recordings from the Robot Emotion Regulation (REMO) study.
+# heart rate analysis itself lives in the heartbeat package
+
+from .loader import load_record, parse_preamble
+from .cache import file_hash, load_cached_record
+from .motion import acceleration_magnitude, mask_spans, motion_mask
+from .timebase import grid_index, reconcile_clocks, resample
+from .phases import event_index, phase_bounds, phase_measures
+from .store import PEAK_ARRAYS, ResultStore, result_key
+from .sweep import StageCache, Sweep, grid
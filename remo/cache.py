@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .loader import COLUMNS, load_record
+
+# bump when the layout of cached recordings changes, older caches are rebuilt
+CACHE_VERSION = 1
+
+# sha1 of a file, read in blocks
+def file_hash(filename, blocksize=2**20):
+	sha1 = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		for block in iter(lambda: f.read(blocksize), b''):
+			sha1.update(block)
+	return sha1.hexdigest()
+
+# directory holding the cached columns of a recording, unique per source path
+def cache_path(filename, cache_dir):
+	source = os.path.abspath(filename)
+	key = hashlib.sha1(source.encode()).hexdigest()[:12]
+	return os.path.join(cache_dir, '%s.%s' % (os.path.basename(source), key))
+
+# the cache stays valid as long as the source keeps its size and mtime,
+# with verify_hash the contents are compared as well
+def is_valid(meta, filename, start_marker, verify_hash=False):
+	stat = os.stat(filename)
+	if (meta.get('version') != CACHE_VERSION or meta.get('start_marker') != start_marker or
+			meta.get('size') != stat.st_size or meta.get('mtime_ns') != stat.st_mtime_ns):
+		return False
+	if verify_hash and meta.get('sha1') != file_hash(filename):
+		return False
+	return True
+
+# parses a recording and stores every column as a .npy file next to a meta.json sidecar
+# holding the preamble info, events and what's needed to check the source for changes
+def build_cache(filename, cache_dir, start_marker='start experiment'):
+	stat = os.stat(filename)
+	info, data, events = load_record(filename, start_marker=start_marker)
+	meta = {
+		'version': CACHE_VERSION,
+		'source': os.path.abspath(filename),
+		'size': stat.st_size,
+		'mtime_ns': stat.st_mtime_ns,
+		'sha1': file_hash(filename),
+		'start_marker': start_marker,
+		'info': info,
+		'events': events,
+		'columns': [name for name, _ in COLUMNS],
+	}
+
+	# written to a temporary directory first so readers never see half a cache
+	os.makedirs(cache_dir, exist_ok=True)
+	target = cache_path(filename, cache_dir)
+	tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+	try:
+		for name, column in data.items():
+			np.save(os.path.join(tmp, name + '.npy'), column)
+		with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+			json.dump(meta, f)
+		if os.path.isdir(target):
+			shutil.rmtree(target, ignore_errors=True)
+		os.replace(tmp, target)
+	except OSError:
+		# another process finished the same cache first
+		shutil.rmtree(tmp, ignore_errors=True)
+		if not os.path.isdir(target):
+			raise
+	return info, data, events
+
+# drop-in replacement for load_record that reuses a cached binary copy of the recording
+# columns of a valid cache are memory-mapped read-only instead of copied into memory
+def load_cached_record(filename, cache_dir, start_marker='start experiment', verify_hash=False):
+	target = cache_path(filename, cache_dir)
+	try:
+		with open(os.path.join(target, 'meta.json')) as f:
+			meta = json.load(f)
+		if is_valid(meta, filename, start_marker, verify_hash):
+			data = {name: np.load(os.path.join(target, name + '.npy'), mmap_mode='r')
+					for name in meta['columns']}
+			events = [tuple(event) for event in meta['events']]
+			return meta['info'], data, events
+	except (OSError, ValueError, KeyError):
+		pass
+	return build_cache(filename, cache_dir, start_marker=start_marker)
@@ -0,0 +1,375 @@
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import io
+import os
+import signal
+import time
+
+import numpy as np
+
+import heartbeat as hb
+from heartbeat.profiling import jsonlines_sink
+from .loader import COLUMNS, PREAMBLE_LINES, find_events, parse_preamble
+from .timebase import resample
+
+# column header of REMO recordings, the line that ends the preamble of a stream
+HEADER = b'unix_timestamp,heart_rate_voltage,accelerometer_x,accelerometer_y,accelerometer_z,servo_position,arduino_timestamp,note'
+
+# analysis parameters of the rolling measures, as in converter.ANALYSIS
+ANALYSIS = {
+	'cutoff': 0.25,
+	'order': 3,
+	'enhance_iterations': 2,
+	'windowsize': 0.75,
+	'bpmmin': 40,
+	'bpmmax': 180,
+}
+
+# fixed-size buffer holding the last capacity samples of every column, oldest overwritten first
+class RingBuffer(object):
+	def __init__(self, capacity, columns=COLUMNS):
+		self.capacity = capacity
+		self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in columns}
+		self.count = 0	# samples added in total
+
+	def __len__(self):
+		return min(self.count, self.capacity)
+
+	# appends the samples of a dict of columns or a structured array
+	def extend(self, table):
+		samples = len(table[next(iter(self.columns))])
+		skip = max(samples - self.capacity, 0)
+		start = (self.count + skip) % self.capacity
+		first = min(samples - skip, self.capacity - start)
+		for name, column in self.columns.items():
+			values = table[name][skip:]
+			column[start:start + first] = values[:first]
+			column[:len(values) - first] = values[first:]
+		self.count += samples
+
+	# copies of the last samples (default all buffered samples) of every column, oldest first
+	def latest(self, samples=None):
+		samples = len(self) if samples is None else min(samples, len(self))
+		start = (self.count - samples) % self.capacity
+		order = (start + np.arange(samples)) % self.capacity
+		return {name: column[order] for name, column in self.columns.items()}
+
+# parses complete csv rows into a structured array with the COLUMNS, "null" values become 0.
+# rows that don't parse are left out, returns the array and the number of rows left out
+def parse_rows(body):
+	body = body.replace(b',null', b',0')
+	try:
+		return np.loadtxt(io.BytesIO(body), delimiter=',', usecols=range(len(COLUMNS)), dtype=COLUMNS,
+						  ndmin=1), 0
+	except ValueError:
+		pass
+	rows = []
+	bad = 0
+	for line in body.split(b'\n'):
+		if not line.strip():
+			continue
+		try:
+			rows.append(np.loadtxt(io.BytesIO(line), delimiter=',', usecols=range(len(COLUMNS)),
+								   dtype=COLUMNS, ndmin=1))
+		except ValueError:
+			bad += 1
+	if rows:
+		return np.concatenate(rows), bad
+	return np.zeros(0, dtype=COLUMNS), bad
+
+# bpm and rmssd of the samples of a session (a dict of columns), resampled onto the arduino
+# clock and analysed as in converter.process_record(), without motion masking. runs in a
+# worker process. returns a dict that holds an error instead when the analysis fails
+def rolling_measures(data, analysis=ANALYSIS):
+	t1 = time.perf_counter()
+	result = {'samples': len(data['heart_rate_voltage'])}
+	try:
+		resampled, base = resample(data, channels=['heart_rate_voltage'])
+		fs = base['sample_rate']
+		filtered = hb.butter_lowpass_filter(resampled['heart_rate_voltage'],
+											cutoff=np.floor(fs * analysis['cutoff']),
+											sample_rate=fs, order=analysis['order'])
+		hrdata = hb.enhance_peaks(filtered, iterations=analysis['enhance_iterations'], inplace=True)
+		working_data = {'hr': hrdata, 'sample_rate': fs}
+		rol_mean = hb.rolmean(hrdata, analysis['windowsize'], fs)
+		hb.fit_peaks(hrdata, rol_mean, fs, bpmmin=analysis['bpmmin'], bpmmax=analysis['bpmmax'],
+					 working_data=working_data)
+		hb.calc_rr(fs, working_data=working_data)
+		hb.check_peaks(working_data=working_data)
+		measures = {}
+		hb.calc_ts_measures(working_data=working_data, measures=measures)
+		result.update(bpm=float(measures['bpm']), rmssd=float(measures['rmssd']), sample_rate=fs)
+	except Exception as error:
+		result['error'] = str(error) or type(error).__name__
+	result['seconds'] = time.perf_counter() - t1
+	return result
+
+# one connected device: its preamble, buffered samples, raw rows waiting to be written and
+# the latest rolling measures. rows are appended to filename as received, which with the
+# preamble and header written first gives a recording that load_record() reads
+class Session(object):
+	def __init__(self, name, capacity):
+		self.name = name
+		self.buffer = RingBuffer(capacity)
+		self.preamble = []
+		self.info = {}
+		self.started = False		# whether the preamble and header were received
+		self.filename = None
+		self.pending = []			# raw rows not yet written
+		self.pending_bytes = 0
+		self.written = 0
+		self.events = []			# (sample, note) of every row that isn't a datapoint
+		self.bad_rows = 0
+		self.lags = []				# ms between the newest sample of every chunk and its arrival
+		self.measures = {}
+		self.analysis = None		# future of the running analysis
+		self.skipped = 0			# analyses skipped because the previous one still ran
+		self.reported = 0			# samples at the last status record
+
+# asyncio server receiving REMO rows from many devices at once, one session per connection.
+# every session keeps its last buffer_seconds of samples in a RingBuffer, has its raw rows
+# appended to a recording in out_dir in batches, and gets rolling bpm and rmssd over the last
+# window seconds every interval seconds, once it has min_seconds of samples, computed in a
+# pool of workers processes.
+# status records (a dict per session and one for the server) are passed to the sinks every
+# status_interval seconds, see heartbeat.profiling.jsonlines_sink()
+class IngestServer(object):
+	def __init__(self, out_dir, window=60.0, interval=5.0, sample_rate=75.0, buffer_seconds=None,
+				 flush_bytes=2**16, flush_interval=1.0, workers=None, status_interval=5.0,
+				 sinks=None, analysis=ANALYSIS, min_seconds=10.0):
+		self.out_dir = out_dir
+		self.window = window
+		self.interval = interval
+		self.capacity = int((buffer_seconds or 1.5 * window) * sample_rate)
+		self.min_samples = max(2, int(min(min_seconds, window) * sample_rate))
+		self.flush_bytes = flush_bytes
+		self.flush_interval = flush_interval
+		self.workers = workers
+		self.status_interval = status_interval
+		self.sinks = list(sinks or [])
+		self.analysis = analysis
+		self.sessions = {}
+		self.connections = 0
+		self.loop_lag = 0.0			# largest delay of the event loop since the last status record
+		self.writer = ThreadPoolExecutor(1)		# a single thread keeps the writes of a session in order
+
+	async def handle(self, reader, writer):
+		self.connections += 1
+		session = Session('session%i' % self.connections, self.capacity)
+		self.sessions[session.name] = session
+		remainder = b''
+		try:
+			while True:
+				chunk = await reader.read(2**16)
+				if not chunk:
+					break
+				received = time.time() * 1000.0
+				chunk = remainder + chunk.replace(b'\r\n', b'\n')
+				end = chunk.rfind(b'\n') + 1
+				remainder = chunk[end:]
+				if end:
+					self.receive(session, chunk[:end], received)
+					if session.pending_bytes >= self.flush_bytes:
+						await self.flush(session)
+			if remainder:
+				self.receive(session, remainder + b'\n', time.time() * 1000.0)
+		finally:
+			writer.close()
+			await self.flush(session)
+			del self.sessions[session.name]
+
+	# handles complete lines of a session, received at received (unix ms)
+	def receive(self, session, body, received):
+		if not session.started:
+			body = self.start(session, body)
+			if not body:
+				return
+		session.pending.append(body)
+		session.pending_bytes += len(body)
+
+		events = find_events(body)
+		table, bad = parse_rows(body)
+		session.bad_rows += bad
+		for row, offset, note in events:
+			session.events.append((session.buffer.count + row, note))
+		if len(table):
+			session.buffer.extend(table)
+			session.lags.append(received - np.max(table['unix_timestamp']))
+
+	# reads the preamble lines up to the header, returns the rest of body. without a preamble
+	# (the first line is a row) an empty one is used. body ends in a newline, so the empty
+	# element after it is left out: a preamble split over several reads gets no blank lines
+	def start(self, session, body):
+		lines = body.split(b'\n')
+		for i, line in enumerate(lines[:-1]):
+			if line.startswith(b'unix_timestamp') or line[:1].isdigit():
+				break
+			session.preamble.append(line)
+		else:
+			return b''
+		if line.startswith(b'unix_timestamp'):
+			i += 1
+		session.started = True
+
+		info = parse_preamble([line.decode(errors='replace') for line in session.preamble])
+		name = '%s_%s_%s' % (info.get('Participant ID', 'unknown'), info.get('Condition ID', 'unknown'),
+							 time.strftime('%Y%m%d-%H%M%S'))
+		session.info = info
+		session.filename = os.path.join(self.out_dir, 'record_%s_%s.csv' % (name, session.name))
+		preamble = (session.preamble + [b''] * PREAMBLE_LINES)[:PREAMBLE_LINES]
+		session.pending.append(b'\n'.join(preamble + [HEADER]) + b'\n')
+		return b'\n'.join(lines[i:])
+
+	# appends the pending rows of a session to its recording
+	async def flush(self, session):
+		if not session.pending:
+			return
+		body = b''.join(session.pending)
+		session.pending = []
+		session.pending_bytes = 0
+		await asyncio.get_running_loop().run_in_executor(self.writer, _append, session.filename, body)
+		session.written += len(body)
+
+	async def flush_loop(self):
+		while True:
+			await asyncio.sleep(self.flush_interval)
+			for session in list(self.sessions.values()):
+				await self.flush(session)
+
+	# starts the analysis of every session with samples, unless its last analysis still runs
+	async def analyse_loop(self, executor):
+		loop = asyncio.get_running_loop()
+		while True:
+			await asyncio.sleep(self.interval)
+			for session in list(self.sessions.values()):
+				if len(session.buffer) < self.min_samples:
+					continue
+				if session.analysis is not None and not session.analysis.done():
+					session.skipped += 1
+					continue
+				data = session.buffer.latest()
+				times = data['unix_timestamp']
+				recent = times >= np.max(times) - 1000.0 * self.window
+				data = {name: column[recent] for name, column in data.items()}
+				session.analysis = loop.run_in_executor(executor, rolling_measures, data, self.analysis)
+				session.analysis.add_done_callback(
+					lambda future, session=session, started=time.perf_counter():
+					self.analysed(session, future, started))
+
+	def analysed(self, session, future, started):
+		if future.cancelled():
+			return
+		if future.exception() is not None:
+			measures = {'error': str(future.exception()) or type(future.exception()).__name__}
+		else:
+			measures = future.result()
+		measures['lag'] = time.perf_counter() - started
+		session.measures = measures
+
+	# measures how late the event loop wakes up, the largest delay is reported in the status
+	async def monitor_loop(self, period=0.1):
+		while True:
+			t1 = time.perf_counter()
+			await asyncio.sleep(period)
+			self.loop_lag = max(self.loop_lag, time.perf_counter() - t1 - period)
+
+	async def status_loop(self):
+		last = time.perf_counter()
+		while True:
+			await asyncio.sleep(self.status_interval)
+			now = time.perf_counter()
+			for record in self.status(now - last):
+				for sink in self.sinks:
+					sink(record)
+			last = now
+
+	# status records of every session over the last elapsed seconds, and of the server
+	def status(self, elapsed):
+		records = []
+		for session in list(self.sessions.values()):
+			lags = np.array(session.lags)
+			session.lags = []
+			record = {
+				'time': time.time(),
+				'session': session.name,
+				'file': session.filename,
+				'samples': session.buffer.count,
+				'rate': (session.buffer.count - session.reported) / elapsed,
+				'events': len(session.events),
+				'bad_rows': session.bad_rows,
+				'written': session.written,
+				'skipped': session.skipped,
+			}
+			if len(lags):
+				record.update(lag_p50=np.percentile(lags, 50), lag_p99=np.percentile(lags, 99),
+							  lag_max=np.max(lags))
+			record.update({'analysis_' + key: value for key, value in session.measures.items()})
+			session.reported = session.buffer.count
+			records.append(record)
+		records.append({'time': time.time(), 'session': None, 'sessions': len(self.sessions),
+						'connections': self.connections, 'loop_lag': self.loop_lag})
+		self.loop_lag = 0.0
+		return records
+
+	# serves on a unix socket at path, or on host:port, until stop (an asyncio.Event) is set
+	async def serve(self, host='127.0.0.1', port=8765, path=None, stop=None):
+		os.makedirs(self.out_dir, exist_ok=True)
+		if path:
+			server = await asyncio.start_unix_server(self.handle, path=path)
+		else:
+			server = await asyncio.start_server(self.handle, host=host, port=port)
+		stop = stop or asyncio.Event()
+		with ProcessPoolExecutor(self.workers) as executor:
+			tasks = [asyncio.ensure_future(coroutine) for coroutine in
+					 (self.flush_loop(), self.analyse_loop(executor), self.monitor_loop(), self.status_loop())]
+			async with server:
+				await stop.wait()
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+			for session in list(self.sessions.values()):
+				await self.flush(session)
+		self.writer.shutdown()
+
+def _append(filename, body):
+	with open(filename, 'ab') as f:
+		f.write(body)
+
+# prints the status of every session on one line
+def print_sink(record):
+	if record['session'] is None:
+		print('%i sessions, event loop lag %.1f ms' % (record['sessions'], 1000 * record['loop_lag']))
+	else:
+		print('%-10s %8i samples %6.1f/s  lag p99 %6.1f ms  bpm %6.1f  rmssd %6.1f  %s' % (
+			record['session'], record['samples'], record['rate'], record.get('lag_p99', np.nan),
+			record.get('analysis_bpm', np.nan), record.get('analysis_rmssd', np.nan),
+			record.get('analysis_error', '')))
+
+async def main(args):
+	sinks = [print_sink] if not args.quiet else []
+	if args.status:
+		sinks.append(jsonlines_sink(args.status))
+	server = IngestServer(args.output, window=args.window, interval=args.interval,
+						  sample_rate=args.sample_rate, workers=args.workers,
+						  status_interval=args.status_interval, sinks=sinks)
+	stop = asyncio.Event()
+	loop = asyncio.get_running_loop()
+	for signum in (signal.SIGINT, signal.SIGTERM):
+		loop.add_signal_handler(signum, stop.set)
+	await server.serve(host=args.host, port=args.port, path=args.unix, stop=stop)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Receive REMO rows from many devices at once and analyse them live.')
+	parser.add_argument('-o', '--output', default='recordings', help='directory the recordings are written to')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8765)
+	parser.add_argument('--unix', help='listen on this unix socket instead of TCP')
+	parser.add_argument('-j', '--workers', type=int, default=None, help='number of analysis worker processes')
+	parser.add_argument('--window', type=float, default=60.0, help='seconds of samples the rolling measures cover')
+	parser.add_argument('--interval', type=float, default=5.0, help='seconds between rolling analyses')
+	parser.add_argument('--sample-rate', type=float, default=75.0, help='nominal sample rate, sizes the ring buffers')
+	parser.add_argument('--status', help='append status records to this JSON lines file')
+	parser.add_argument('--status-interval', type=float, default=5.0, help='seconds between status records')
+	parser.add_argument('-q', '--quiet', action='store_true', help='do not print the status')
+	asyncio.run(main(parser.parse_args()))
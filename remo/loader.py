@@ -0,0 +1,82 @@
+import io
+
+import numpy as np
+
+# number of preamble lines before the column header in REMO recordings
+PREAMBLE_LINES = 7
+
+# column types of the numeric REMO columns, the trailing note column is read separately
+COLUMNS = [
+	('unix_timestamp', np.int64),
+	('heart_rate_voltage', np.int64),
+	('accelerometer_x', np.float64),
+	('accelerometer_y', np.float64),
+	('accelerometer_z', np.float64),
+	('servo_position', np.int64),
+	('arduino_timestamp', np.int64),
+]
+
+# note of every row that isn't an event
+DATAPOINT = b',datapoint'
+
+# reads "key: value" pairs (e.g. Participant ID, Condition ID) from the preamble
+def parse_preamble(lines):
+	info = {}
+	for line in lines:
+		field = line.split(',', 1)[0]
+		if ':' not in field:
+			continue
+		key, value = field.split(':', 1)
+		info[key.strip()] = value.strip()
+	return info
+
+# finds all rows of a csv body whose note isn't "datapoint" without splitting it into lines
+# returns a list of (row, byte offset of the row, note), blank lines aren't counted as rows
+def find_events(body):
+	raw = np.frombuffer(body, dtype=np.uint8)
+	ends = np.flatnonzero(raw == ord('\n'))
+	if len(raw) and raw[-1] != ord('\n'):
+		ends = np.append(ends, len(raw))
+	starts = np.concatenate(([0], ends[:-1] + 1))
+
+	nonblank = ends > starts
+	is_datapoint = (ends - starts) >= len(DATAPOINT)
+	for i, char in enumerate(DATAPOINT):
+		position = np.maximum(ends - len(DATAPOINT) + i, 0)
+		is_datapoint &= raw[position] == char
+	rows = np.cumsum(nonblank) - 1
+
+	events = []
+	for line in np.flatnonzero(nonblank & ~is_datapoint):
+		row = body[starts[line]:ends[line]].decode()
+		events.append((int(rows[line]), int(starts[line]), row.rsplit(',', 1)[-1]))
+	return events
+
+# loads a REMO recording from the "start experiment" marker on
+# (from the first row if there is no marker)
+# returns the preamble info, a dict of typed column arrays and a list of
+# (row, note) events for every note that isn't "datapoint", rows counted from the start
+# "null" values become 0 and heart_rate_voltage is clamped to [0, 1024]
+def load_record(filename, start_marker='start experiment'):
+	with open(filename, 'rb') as csvfile:
+		text = csvfile.read().replace(b'\r\n', b'\n')
+
+	lines = text.split(b'\n', PREAMBLE_LINES + 1)
+	info = parse_preamble([line.decode() for line in lines[:PREAMBLE_LINES]])
+	body = lines[PREAMBLE_LINES + 1] if len(lines) > PREAMBLE_LINES + 1 else b''
+
+	events = find_events(body)
+	start_row = 0
+	for row, offset, note in events:
+		if note == start_marker:
+			start_row = row
+			body = body[offset:]
+			break
+	events = [(row - start_row, note) for row, offset, note in events if row >= start_row]
+
+	table = np.loadtxt(io.BytesIO(body.replace(b',null', b',0')), delimiter=',',
+					   usecols=range(len(COLUMNS)), dtype=COLUMNS, ndmin=1)
+	data = {name: np.ascontiguousarray(table[name]) for name, _ in COLUMNS}
+	np.clip(data['heart_rate_voltage'], 0, 1024, out=data['heart_rate_voltage'])
+
+	return info, data, events
@@ -0,0 +1,53 @@
+import numpy as np
+
+# magnitude of the acceleration of every sample, in the accelerometer's units (m/s^2)
+def acceleration_magnitude(data):
+	return np.sqrt(np.square(data['accelerometer_x']) + np.square(data['accelerometer_y']) +
+				   np.square(data['accelerometer_z']))
+
+# widens every True run of a mask by padding samples on both sides
+def widen_mask(mask, padding):
+	if padding <= 0:
+		return mask.copy()
+	masked = np.concatenate(([0], np.cumsum(mask)))
+	positions = np.arange(len(mask))
+	window_end = np.minimum(positions + padding + 1, len(mask))
+	window_start = np.maximum(positions - padding, 0)
+	return (masked[window_end] - masked[window_start]) > 0
+
+# marks samples recorded while the participant moved, as a boolean array:
+# where the acceleration magnitude deviates more than magnitude_threshold from its median
+# (gravity, when sitting still) or the jerk, the derivative of the magnitude smoothed over
+# smoothing seconds, exceeds jerk_threshold (m/s^3). spans are widened by padding seconds
+# on both sides to cover the artifact's onset and decay in the heart rate signal.
+# valid marks the rows holding a sample, by default those with an arduino timestamp (all
+# rows of resampled data). other rows, e.g. events whose "null" values read as 0, are left
+# out of the median and take the magnitude interpolated from their neighbours
+def motion_mask(data, sample_rate, magnitude_threshold=1.0, jerk_threshold=20.0, smoothing=0.1,
+				padding=0.5, valid=None):
+	magnitude = acceleration_magnitude(data)
+	if valid is None and 'arduino_timestamp' in data:
+		valid = data['arduino_timestamp'] > 0
+	samples = np.arange(len(magnitude)) if valid is None else np.flatnonzero(valid)
+	if len(samples) == 0:
+		return np.zeros(len(magnitude), dtype=bool)
+	median = np.median(magnitude[samples])
+	if len(samples) < len(magnitude):
+		magnitude = np.interp(np.arange(len(magnitude)), samples, magnitude[samples])
+	mask = np.abs(magnitude - median) > magnitude_threshold
+
+	window = max(1, int(smoothing * sample_rate))
+	if len(magnitude) > window:
+		cumsum = np.concatenate(([0], np.cumsum(magnitude)))
+		smoothed = (cumsum[window:] - cumsum[:-window]) / window
+		jerk = np.abs(np.diff(smoothed)) * sample_rate
+		# the jerk between two window means belongs to the window's center sample
+		center = (window // 2) + 1
+		mask[center:center + len(jerk)] |= jerk > jerk_threshold
+
+	return widen_mask(mask, int(padding * sample_rate))
+
+# start and end sample (exclusive) of every span of a mask
+def mask_spans(mask):
+	edges = np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0])))
+	return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
@@ -0,0 +1,41 @@
+import numpy as np
+
+import heartbeat as hb
+
+# rows of every event note, e.g. {'start experiment': array([0]), 'end experiment': array([21810])}
+def event_index(events):
+	index = {}
+	for row, note in events:
+		index.setdefault(note, []).append(row)
+	return {note: np.array(rows, dtype=np.int64) for note, rows in index.items()}
+
+# the phases of a recording as a list of (name, start, end) rows, end exclusive.
+# by default every event starts a phase named after its note, which lasts until the
+# next event or the end of the recording (at row end). phases can pick them instead,
+# as a dict of name -> (start note, end note), using the first row of each note
+def phase_bounds(events, end, phases=None):
+	if phases is None:
+		rows = [row for row, note in events] + [end]
+		bounds = [(note, row, next_row) for (row, note), next_row in zip(events, rows[1:])]
+	else:
+		index = event_index(events)
+		bounds = []
+		for name, (start_note, end_note) in phases.items():
+			if start_note in index and end_note in index:
+				bounds.append((name, index[start_note][0], index[end_note][0]))
+	return [(name, start, stop) for name, start, stop in bounds if stop > start]
+
+# measures of every phase of a recording that was processed once as a whole, sliced from
+# the peaks and RR intervals in its working_data, see hb.segment_measures(). bounds are
+# (name, start sample, end sample) as from phase_bounds(), returns a list of dicts of
+# measures that also hold the phase name
+def phase_measures(bounds, sample_rate, working_data, calc_freq=False, freq_method='lomb',
+				   freq_resample_rate=4.0):
+	if len(bounds) == 0:
+		return []
+	names, starts, ends = zip(*bounds)
+	measures = hb.segment_measures(starts, ends, sample_rate, working_data=working_data,
+								   calc_freq=calc_freq, freq_method=freq_method,
+								   freq_resample_rate=freq_resample_rate)
+	return [dict({key: values[i] for key, values in measures.items()}, phase=name)
+			for i, name in enumerate(names)]
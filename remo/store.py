@@ -0,0 +1,103 @@
+import hashlib
+import io
+import json
+import sqlite3
+import time
+
+import numpy as np
+
+# bump when the layout of stored results changes, older results are ignored
+STORE_VERSION = 1
+
+# peak arrays of working_data that are stored with the measures
+PEAK_ARRAYS = ['peaklist', 'ybeat', 'binary_peaklist', 'removed_beats', 'RR_list', 'RR_list_cor',
+			   'RR_masklist']
+
+SCHEMA = '''
+create table if not exists results (
+	key text primary key,
+	file text,
+	sha1 text,
+	params text,
+	info text,
+	measures text,
+	phases text,
+	created real
+);
+create table if not exists arrays (
+	key text,
+	name text,
+	data blob,
+	primary key (key, name)
+);
+'''
+
+# key of the results of a recording, from the hash of its contents and every parameter
+# of the analysis, so any change to either gives a new key
+def result_key(sha1, params):
+	canonical = json.dumps({'sha1': sha1, 'params': params, 'version': STORE_VERSION},
+						   sort_keys=True, default=_to_builtin)
+	return hashlib.sha1(canonical.encode()).hexdigest()
+
+def _to_builtin(value):
+	if isinstance(value, np.generic):
+		return value.item()
+	raise TypeError('%r is not JSON serializable' % (value,))
+
+# only scalar measures are stored, e.g. not the spline in interp_rr_function
+def _scalars(measures):
+	return {k: v for k, v in measures.items() if np.isscalar(v)}
+
+# persistent results of analysed recordings in an SQLite database, keyed by result_key()
+# measures, preamble info and phase measures are stored as JSON, peak arrays as .npy blobs
+class ResultStore(object):
+	def __init__(self, path):
+		self.path = path
+		self.connection = sqlite3.connect(path, timeout=60)
+		self.connection.executescript(SCHEMA)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		self.connection.close()
+
+	def __contains__(self, key):
+		return self.connection.execute('select 1 from results where key = ?', (key,)).fetchone() is not None
+
+	def keys(self):
+		return [row[0] for row in self.connection.execute('select key from results')]
+
+	# stores the results of a recording (with contents hash sha1) analysed with params,
+	# replacing earlier results with the same key
+	def put(self, key, filename, sha1, params, info, measures, phases=(), working_data=None):
+		arrays = []
+		for name in PEAK_ARRAYS:
+			if working_data is not None and name in working_data:
+				buffer = io.BytesIO()
+				np.save(buffer, np.asarray(working_data[name]), allow_pickle=False)
+				arrays.append((key, name, buffer.getvalue()))
+		with self.connection:
+			self.connection.execute('delete from arrays where key = ?', (key,))
+			self.connection.execute(
+				'insert or replace into results values (?, ?, ?, ?, ?, ?, ?, ?)',
+				(key, filename, sha1, json.dumps(params, sort_keys=True, default=_to_builtin),
+				 json.dumps(info), json.dumps(_scalars(measures), default=_to_builtin),
+				 json.dumps([_scalars(phase) for phase in phases], default=_to_builtin), time.time()))
+			self.connection.executemany('insert into arrays values (?, ?, ?)', arrays)
+
+	# the stored (info, measures, phases) of a key, None when it isn't stored
+	def get(self, key):
+		row = self.connection.execute('select info, measures, phases from results where key = ?',
+									  (key,)).fetchone()
+		if row is None:
+			return None
+		return json.loads(row[0]), json.loads(row[1]), json.loads(row[2])
+
+	# the stored peak arrays of a key, as a dict of numpy arrays
+	def arrays(self, key):
+		rows = self.connection.execute('select name, data from arrays where key = ?', (key,))
+		return {name: np.load(io.BytesIO(data), allow_pickle=False) for name, data in rows}
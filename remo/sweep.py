@@ -0,0 +1,234 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import sys
+import threading
+
+import numpy as np
+
+import heartbeat as hb
+
+# the stages of the analysis of one recording, in order, with the parameters each adds.
+# the result of a stage depends on its own parameters and those of all stages before it,
+# except that the stages after fit_peaks only depend on the threshold the BPM range selects.
+# the parameters are those of converter.ANALYSIS, plus calc_freq
+STAGES = [
+	('filter', ['cutoff', 'highpass', 'order', 'dtype']),
+	('enhance', ['enhance_iterations']),
+	('clipping', ['interp_clipping', 'interp_threshold']),
+	('rolmean', ['windowsize']),
+	('detect', []),
+	('fit_peaks', ['bpmmin', 'bpmmax']),
+	('rejection', []),
+	('measures', ['calc_freq', 'freq_method', 'freq_resample_rate']),
+]
+PARAMS = [name for stage, names in STAGES for name in names]
+
+# every combination of the passed values, as a list of parameter dicts, e.g.
+# grid(cutoff=[0.2, 0.25], windowsize=[0.5, 0.75, 1.0]) gives 6 points. points sharing
+# the parameters of early stages come one after another, so their results are reused
+# while they are still cached
+def grid(**values):
+	unknown = set(values) - set(PARAMS)
+	if unknown:
+		raise ValueError('unknown parameters: %s' % ', '.join(sorted(unknown)))
+	names = [name for name in PARAMS if name in values]
+	return [dict(zip(names, combination))
+			for combination in itertools.product(*[values[name] for name in names])]
+
+# approximate memory held by a stage result, its arrays and containers
+def _nbytes(value):
+	if isinstance(value, np.ndarray):
+		return value.nbytes
+	if isinstance(value, dict):
+		return sys.getsizeof(value) + sum(_nbytes(v) for v in value.values())
+	if isinstance(value, (list, tuple)):
+		return sys.getsizeof(value) + sum(_nbytes(v) for v in value)
+	return sys.getsizeof(value)
+
+# thread-safe cache of stage results, evicting the least recently used results once they hold
+# more than max_bytes. a result that is being computed by one thread is waited for by the
+# others instead of being computed again. hits and misses are counted per stage
+class StageCache(object):
+	def __init__(self, max_bytes=2**29):
+		self.max_bytes = max_bytes
+		self.nbytes = 0
+		self.entries = OrderedDict()
+		self.sizes = {}
+		self.pending = {}
+		self.hits = {}
+		self.misses = {}
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.entries)
+
+	# the result stored for key, computed with compute() when it isn't stored.
+	# the first item of a key names its stage
+	def get(self, key, compute):
+		with self.lock:
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				self.hits[key[0]] = self.hits.get(key[0], 0) + 1
+				return self.entries[key]
+			future = self.pending.get(key)
+			if future is None:
+				future = self.pending[key] = Future()
+				self.misses[key[0]] = self.misses.get(key[0], 0) + 1
+				owner = True
+			else:
+				self.hits[key[0]] = self.hits.get(key[0], 0) + 1
+				owner = False
+		if not owner:
+			return future.result()
+
+		try:
+			value = compute()
+		except BaseException as e:
+			with self.lock:
+				del self.pending[key]
+			future.set_exception(e)
+			raise
+		with self.lock:
+			del self.pending[key]
+			self._store(key, value)
+		future.set_result(value)
+		return value
+
+	def _store(self, key, value):
+		size = _nbytes(value)
+		if size > self.max_bytes:
+			return
+		while self.entries and self.nbytes + size > self.max_bytes:
+			old_key, _ = self.entries.popitem(last=False)
+			self.nbytes -= self.sizes.pop(old_key)
+		self.entries[key] = value
+		self.sizes[key] = size
+		self.nbytes += size
+
+	# hits and misses of every stage, e.g. {'filter': {'hits': 98, 'misses': 2}, ...}
+	def stats(self):
+		with self.lock:
+			return {stage: {'hits': self.hits.get(stage, 0), 'misses': self.misses.get(stage, 0)}
+					for stage, _ in STAGES}
+
+# parameter sweep over the analysis of one recording. the raw heart rate voltage is filtered,
+# enhanced, repaired where it clips and fitted as in converter.process_record(), with params
+# (a dict like converter.ANALYSIS plus calc_freq) as the defaults of every point. the result
+# of every stage is cached, keyed by the parameters it depends on, so points that only differ
+# in later stages share the earlier ones: a grid costs about one run per distinct prefix
+# artifact_mask (see motion_mask()) is the same for every point
+class Sweep(object):
+	def __init__(self, voltage, sample_rate, params, artifact_mask=None, cache=None):
+		missing = set(PARAMS) - set(params)
+		if missing:
+			raise ValueError('missing parameters: %s' % ', '.join(sorted(missing)))
+		self.voltage = voltage
+		self.sample_rate = sample_rate
+		self.params = dict(params)
+		self.artifact_mask = artifact_mask
+		self.cache = StageCache() if cache is None else cache
+
+	# key of the result of a stage for a point, from the parameters of that and earlier stages.
+	# BPM ranges that select the same threshold share the results of the stages after fit_peaks
+	def stage_key(self, stage, point):
+		key = [stage]
+		for name, names in STAGES:
+			if name == 'fit_peaks' and stage != name:
+				key.append(('best', self._result('fit_peaks', point)['best']))
+			else:
+				key.extend((param, point[param]) for param in names)
+			if name == stage:
+				return tuple(key)
+		raise ValueError('unknown stage: %s' % stage)
+
+	def _result(self, stage, point):
+		return self.cache.get(self.stage_key(stage, point), lambda: getattr(self, '_' + stage)(point))
+
+	# results of the stages, which must not change the cached results of earlier stages
+	def _filter(self, point):
+		fs = self.sample_rate
+		cutoff = np.floor(fs * point['cutoff'])
+		dtype = np.dtype(point['dtype'])
+		if point['highpass']:
+			return hb.bandpass_filter(self.voltage, point['highpass'], cutoff, sample_rate=fs,
+									  order=point['order'], dtype=dtype)
+		return hb.butter_lowpass_filter(self.voltage, cutoff=cutoff, sample_rate=fs,
+										order=point['order'], dtype=dtype)
+
+	def _enhance(self, point):
+		return hb.enhance_peaks(self._result('filter', point), iterations=point['enhance_iterations'])
+
+	# the repaired signal and the working_data holding the clipping segments
+	def _clipping(self, point):
+		hrdata = self._result('enhance', point)
+		working_data = {}
+		if point['interp_clipping']:
+			# interpolate_peaks() repairs in place
+			hrdata = hb.interpolate_peaks(hrdata.copy(), self.sample_rate,
+										  threshold=point['interp_threshold'],
+										  working_data=working_data)
+		working_data['hr'] = hrdata
+		working_data['sample_rate'] = self.sample_rate
+		return working_data
+
+	def _rolmean(self, point):
+		hrdata = self._result('clipping', point)['hr']
+		return hb.rolmean(hrdata, point['windowsize'], self.sample_rate)
+
+	# the peaks at every threshold, which all BPM ranges choose from
+	def _detect(self, point):
+		return hb.fit_candidates(self._result('clipping', point)['hr'], self._result('rolmean', point),
+								 self.sample_rate, artifact_mask=self.artifact_mask)
+
+	def _fit_peaks(self, point):
+		working_data = dict(self._result('clipping', point))
+		hb.fit_peaks(working_data['hr'], self._result('rolmean', point), self.sample_rate,
+					 bpmmin=point['bpmmin'], bpmmax=point['bpmmax'], working_data=working_data,
+					 artifact_mask=self.artifact_mask, candidates=self._result('detect', point))
+		return working_data
+
+	def _rejection(self, point):
+		working_data = dict(self._result('fit_peaks', point))
+		hb.calc_rr(self.sample_rate, working_data=working_data)
+		hb.check_peaks(working_data=working_data)
+		return working_data
+
+	# the measures as from hb.process()
+	def _measures(self, point):
+		working_data = dict(self._result('rejection', point))
+		measures = {}
+		hb.calc_ts_measures(working_data=working_data, measures=measures)
+		hb.calc_breathing(self.sample_rate, working_data=working_data, measures=measures)
+		if point['interp_clipping']:
+			measures['clipping_count'] = working_data['clipping_count']
+			measures['clipping_duration'] = working_data['clipping_duration']
+		if self.artifact_mask is not None:
+			measures['artifact_duration'] = np.count_nonzero(self.artifact_mask) / self.sample_rate
+		if point['calc_freq']:
+			hb.calc_fd_measures(working_data['hr'], self.sample_rate, method=point['freq_method'],
+								working_data=working_data, measures=measures,
+								resample_rate=point['freq_resample_rate'])
+		return measures
+
+	def _point(self, point):
+		unknown = set(point) - set(PARAMS)
+		if unknown:
+			raise ValueError('unknown parameters: %s' % ', '.join(sorted(unknown)))
+		return dict(self.params, **point)
+
+	# the measures of one point, a dict overriding any of the params
+	def measures(self, point):
+		return dict(self._result('measures', self._point(point)))
+
+	# the working_data (peaks, RR intervals) of one point
+	def working_data(self, point):
+		return dict(self._result('rejection', self._point(point)))
+
+	# the measures of every point, in order, computed by workers threads
+	def run(self, points, workers=None):
+		points = [self._point(point) for point in points]
+		if workers == 1:
+			return [self.measures(point) for point in points]
+		with ThreadPoolExecutor(workers) as executor:
+			return list(executor.map(self.measures, points))
@@ -0,0 +1,119 @@
+import numpy as np
+
+# channels resampled by default, all analog channels of a REMO recording
+CHANNELS = ['heart_rate_voltage', 'accelerometer_x', 'accelerometer_y', 'accelerometer_z',
+			'servo_position']
+
+# the arduino's micros() counter overflows every 2^32 microseconds (about 71.6 minutes)
+MICROS_PERIOD = 2**32
+
+# arduino timestamps made monotonic across micros() overflows, rows without a
+# timestamp (0, e.g. event rows) are left at 0
+def unwrap_micros(arduino, period=MICROS_PERIOD):
+	arduino = np.asarray(arduino, dtype=np.int64)
+	unwrapped = arduino.copy()
+	valid = arduino > 0
+	values = arduino[valid]
+	wraps = np.concatenate(([0], np.cumsum(np.diff(values) < -(period // 2))))
+	unwrapped[valid] = values + wraps * period
+	return unwrapped
+
+# least squares fit of unix time (ms) against arduino time (us), unix = scale * arduino / 1000 + offset
+# fitted twice, the second time without the outliers of the first fit (serial hiccups)
+# drift_ppm is how much faster (>0) the unix clock runs than the arduino clock
+def fit_clocks(unix, arduino):
+	x = np.asarray(arduino, dtype=np.float64) / 1000.0
+	y = np.asarray(unix, dtype=np.float64)
+	x0, y0 = x[0], y[0]
+	x = x - x0
+	y = y - y0
+	use = np.ones(len(x), dtype=bool)
+	for _ in range(2):
+		x_mean, y_mean = np.mean(x[use]), np.mean(y[use])
+		scale = np.sum((x[use] - x_mean) * (y[use] - y_mean)) / np.sum(np.square(x[use] - x_mean))
+		intercept = y_mean - scale * x_mean
+		residuals = y - (scale * x + intercept)
+		mad = np.median(np.abs(residuals - np.median(residuals)))
+		use = np.abs(residuals) <= max(5 * mad, 1.0)
+	return {
+		'scale': scale,
+		'offset': y0 + intercept - scale * x0,
+		'drift_ppm': (scale - 1) * 1e6,
+		'residual_ms': np.std(residuals[use]),
+	}
+
+# reconciles the clocks of a recording: the sample times (unix ms) of every row are taken
+# from the arduino clock mapped onto unix time. without arduino timestamps the unix
+# timestamps are used as they are. rows without a sample (e.g. events) get the time
+# interpolated from their neighbours and are marked invalid. returns a dict with
+#	times			the sample time of every row
+#	valid			whether a row holds a sample
+#	sample_rate		rate of the uniform grid, by default the mean rate of the samples
+#	start, count	time of the first grid sample and the number of grid samples
+#	scale, offset, drift_ppm, residual_ms	the clock fit, see fit_clocks()
+def reconcile_clocks(data, sample_rate=None):
+	unix = np.asarray(data['unix_timestamp'], dtype=np.int64)
+	arduino = unwrap_micros(data['arduino_timestamp'])
+	valid = (arduino > 0) & (unix > 0)
+	# a sample needs a time after that of the sample before it
+	valid[valid] = np.concatenate(([True], np.diff(arduino[valid]) > 0))
+	rows = np.arange(len(unix))
+
+	if np.count_nonzero(valid) >= 2:
+		info = fit_clocks(unix[valid], arduino[valid])
+		times = info['scale'] * (arduino / 1000.0) + info['offset']
+	else:
+		valid = unix > 0
+		valid[valid] = np.concatenate(([True], np.diff(unix[valid]) > 0))
+		info = {'scale': 1.0, 'offset': 0.0, 'drift_ppm': np.nan, 'residual_ms': np.nan}
+		times = unix.astype(np.float64)
+	if np.count_nonzero(valid) < 2:
+		raise ValueError('a recording needs at least two timestamped samples')
+	times = np.interp(rows, rows[valid], times[valid])
+
+	duration = times[valid][-1] - times[valid][0]
+	if sample_rate is None:
+		sample_rate = 1000.0 * (np.count_nonzero(valid) - 1) / duration
+	info['times'] = times
+	info['valid'] = valid
+	info['sample_rate'] = sample_rate
+	info['start'] = times[valid][0]
+	info['count'] = int(np.floor(duration * sample_rate / 1000.0)) + 1
+	return info
+
+# grid sample nearest to the time of each row, e.g. to move event rows onto the grid
+def grid_index(base, rows):
+	times = base['times'][np.asarray(rows, dtype=np.int64)]
+	index = np.round((times - base['start']) * base['sample_rate'] / 1000.0).astype(np.int64)
+	return np.clip(index, 0, base['count'] - 1)
+
+# linearly interpolates the channels onto the uniform grid of reconcile_clocks(), chunksize grid
+# samples at a time. the interpolation positions and weights of a chunk are computed once
+# for all channels. yields the first grid index, the grid times and a dict of channels per chunk
+def resample_chunks(data, base, channels=CHANNELS, chunksize=2**20):
+	rows = np.flatnonzero(base['valid'])
+	times = base['times'][rows]
+	period = 1000.0 / base['sample_rate']
+	for start in range(0, base['count'], chunksize):
+		grid = base['start'] + period * np.arange(start, min(start + chunksize, base['count']))
+		right = np.clip(np.searchsorted(times, grid, side='right'), 1, len(times) - 1)
+		left = right - 1
+		weight = np.clip((grid - times[left]) / (times[right] - times[left]), 0, 1)
+		left, right = rows[left], rows[right]
+		yield start, grid, {
+			name: data[name][left] + weight * (data[name][right] - data[name][left].astype(np.float64))
+			for name in channels
+		}
+
+# resamples a recording onto a uniform grid, see reconcile_clocks(), in chunks of chunksize samples
+# returns a dict with the grid times (unix_timestamp, float ms) and float channels, and the timebase
+def resample(data, sample_rate=None, channels=CHANNELS, chunksize=2**20):
+	base = reconcile_clocks(data, sample_rate)
+	resampled = {'unix_timestamp': np.empty(base['count'])}
+	for name in channels:
+		resampled[name] = np.empty(base['count'])
+	for start, grid, chunk in resample_chunks(data, base, channels, chunksize):
+		resampled['unix_timestamp'][start:start + len(grid)] = grid
+		for name in channels:
+			resampled[name][start:start + len(grid)] = chunk[name]
+	return resampled, base